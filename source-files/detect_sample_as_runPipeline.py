@@ -1,10 +1,102 @@
 # import the necessary packages
 import numpy as np
 import cv2
-from enum import Enum
+from enum import Enum, IntEnum
+import atexit
+import os
 import sys
 import platform
+import threading
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#################################################################
+# PipelineLog.py
+#################################################################
+# Leveled logging for the pipeline. On the Limelight print() goes to
+# a slow synchronous console, so instead of printing, messages are
+# kept in a bounded in-memory buffer (the oldest are dropped when it
+# is full) and written out by flush(), which runPipeline calls on
+# idle and black frames, i.e. off the hot path, and at exit. The
+# robot switches to another pipeline when it goes idle and atexit
+# doesn't run if the process is killed, so a message at FLUSH_LEVEL
+# or above, e.g. the exception behind a PYTHON_APP_CRASH, is written
+# out at once; those are rare.
+#
+# The message is a %-style format string and its arguments are only
+# formatted when the message is flushed. Messages below the current
+# level are discarded immediately. Where even the arguments are
+# expensive to compute test the level first, e.g.
+#     if pipeline_log.debug_enabled:
+#         pipeline_log.debug("Bins %s", expensive_summary())
+class PipelineLog:
+    class Level(IntEnum):
+        DEBUG = 10
+        INFO = 20
+        WARNING = 30
+        ERROR = 40
+        OFF = 100
+
+    LEVEL = Level.WARNING  # production default
+    FLUSH_LEVEL = Level.ERROR  # messages at or above this level are written out at once
+    CAPACITY = 256  # messages
+
+    def __init__(self, p_level=LEVEL, p_capacity=CAPACITY):
+        self._records = deque(maxlen=p_capacity)
+        self._flush_lock = threading.Lock()  # errors may be logged on the AsyncPipeline thread
+        self.num_dropped = 0
+        self.set_level(p_level)
+
+    def set_level(self, p_level):
+        self.level = p_level
+        self.debug_enabled = p_level <= PipelineLog.Level.DEBUG
+        self.info_enabled = p_level <= PipelineLog.Level.INFO
+
+    def log(self, p_level, p_message, *p_args):
+        if p_level < self.level:
+            return
+        if len(self._records) == self._records.maxlen:
+            self.num_dropped += 1
+        self._records.append((p_level, p_message, p_args))
+        if p_level >= self.FLUSH_LEVEL:
+            self.flush()
+
+    def debug(self, p_message, *p_args):
+        if self.debug_enabled:
+            self.log(PipelineLog.Level.DEBUG, p_message, *p_args)
+
+    def info(self, p_message, *p_args):
+        if self.info_enabled:
+            self.log(PipelineLog.Level.INFO, p_message, *p_args)
+
+    def warning(self, p_message, *p_args):
+        self.log(PipelineLog.Level.WARNING, p_message, *p_args)
+
+    def error(self, p_message, *p_args):
+        self.log(PipelineLog.Level.ERROR, p_message, *p_args)
+
+    def has_records(self):
+        return len(self._records) > 0
+
+    # Formats and writes all buffered messages to p_stream (default
+    # stdout).
+    def flush(self, p_stream=None):
+        stream = sys.stdout if p_stream is None else p_stream
+        with self._flush_lock:
+            if self.num_dropped:
+                stream.write(f"WARNING {self.num_dropped} log messages dropped\n")
+                self.num_dropped = 0
+
+            while self._records:
+                level, message, args = self._records.popleft()
+                stream.write(level.name + " " + (message % args if args else message) + "\n")
+            stream.flush()
+
+
+pipeline_log = PipelineLog()
+atexit.register(pipeline_log.flush)
 
 ## 7/13/2025 copy/paste from Pycharm AutomaticThresholding project
 # with modifications to contour filtering for the Limelight.
@@ -13,10 +105,34 @@ import traceback
 #################################################################
 class ImageUtils:
 
+    # True if every pixel of the BGR image is black in grayscale, i.e.
+    # the same test as countNonZero of the whole gray image == 0. Every
+    # p_row_stride'th row is converted first and the answer is False as
+    # soon as one of those rows has a lit pixel; only an image whose
+    # sampled rows are all dark is converted in full. A stride of 1
+    # always converts the whole image.
     @staticmethod
-    def apply_grayscale_threshold(p_grayscale_image, grayscale_threshold_low):
+    def is_black_image(p_bgr_image, p_row_stride=1, p_buffers=None):
+        if p_row_stride > 1:
+            sampled_rows = p_bgr_image[::p_row_stride]
+            sampled_shape = sampled_rows.shape[:2]
+            gray_rows = cv2.cvtColor(sampled_rows, cv2.COLOR_BGR2GRAY,
+                                     dst=None if p_buffers is None else p_buffers.get("gray_rows", sampled_shape))
+            if cv2.countNonZero(gray_rows) != 0:
+                return False
+
+        gray_image = cv2.cvtColor(p_bgr_image, cv2.COLOR_BGR2GRAY,
+                                  dst=None if p_buffers is None else p_buffers.get("gray_image",
+                                                                                   p_bgr_image.shape[:2]))
+        return cv2.countNonZero(gray_image) == 0
+
+    # If p_dst is supplied it must have the same shape as the input
+    # and receives the thresholded image.
+    @staticmethod
+    def apply_grayscale_threshold(p_grayscale_image, grayscale_threshold_low, p_dst=None):
         thresh_binary_flag = cv2.THRESH_BINARY if grayscale_threshold_low >= 0 else cv2.THRESH_BINARY_INV
-        _, thresholded = cv2.threshold(p_grayscale_image, grayscale_threshold_low, 255, thresh_binary_flag)
+        _, thresholded = cv2.threshold(p_grayscale_image, grayscale_threshold_low, 255, thresh_binary_flag,
+                                       dst=p_dst)
         return thresholded
 
     @staticmethod
@@ -47,54 +163,52 @@ class ImageUtils:
     @staticmethod
     def get_hue_range(p_hist, dominant_bin_index):
         # Log all non-zero histogram bins.
-        min_pixel_count = np.min(p_hist)
-        print("Minimum pixel count", min_pixel_count)
-        for bin_index, count in enumerate(p_hist):
-            if count[0] != min_pixel_count:
-                print(f"Bin {bin_index}: {count[0]}")
+        hist = np.asarray(p_hist).reshape(-1)
+        min_pixel_count = np.min(hist)
+        if pipeline_log.debug_enabled:
+            pipeline_log.debug("Minimum pixel count %s", min_pixel_count)
+            for bin_index in np.flatnonzero(hist != min_pixel_count):
+                pipeline_log.debug("Bin %d: %s", bin_index, hist[bin_index])
 
         # Look at bins on each side of the dominant bin/hue
         # until you find one with the minimum pixel count,
-        # typically 0. Be mindful of the wrap-around at 0/180.
-        adjacent_bin = dominant_bin_index
-        while True:
-            adjacent_bin = adjacent_bin - 1
-            if adjacent_bin == -1:
-                adjacent_bin = 179  # crossed boundary at 0
-
-            print("Bin " + str(adjacent_bin) + ", pixel count " + str(p_hist[adjacent_bin]))
-            if p_hist[adjacent_bin] == min_pixel_count:
-                print("Found minimum pixel count at bin " + str(adjacent_bin))
-                hsv_hue_low = adjacent_bin
-                break
-
-        adjacent_bin = dominant_bin_index
-        while True:
-            adjacent_bin = adjacent_bin + 1
-            if adjacent_bin == 180:
-                adjacent_bin = 0  # crossed boundary at 179
-
-            print("Bin " + str(adjacent_bin) + ", pixel count " + str(p_hist[adjacent_bin]))
-            if p_hist[adjacent_bin] == min_pixel_count:
-                print("Found minimum pixel count at bin " + str(adjacent_bin))
-                hsv_hue_high = adjacent_bin
-                break
-
-        print("Hue low, high " + str(hsv_hue_low) + ", " + str(hsv_hue_high))
+        # typically 0. Be mindful of the wrap-around at 0/180:
+        # the bins are visited in the order dominant - 1, dominant - 2,
+        # ... 0, 179, ... down and dominant + 1, ... 179, 0, ... up,
+        # ending at the dominant bin itself.
+        num_bins = hist.shape[0]
+        steps = np.arange(1, num_bins + 1)
+        at_minimum = hist == min_pixel_count
+
+        bins_down = (dominant_bin_index - steps) % num_bins
+        hsv_hue_low = int(bins_down[np.argmax(at_minimum[bins_down])])
+        bins_up = (dominant_bin_index + steps) % num_bins
+        hsv_hue_high = int(bins_up[np.argmax(at_minimum[bins_up])])
+
+        pipeline_log.debug("Hue low, high %d, %d", hsv_hue_low, hsv_hue_high)
         return hsv_hue_low, hsv_hue_high
 
     # Based on - but not the same as - AutomaticThresholding.ImageUtils.
+    # If p_buffers (FrameBuffers) is supplied the binary output is taken
+    # from it instead of being allocated. The binary output is only drawn
+    # if the caller asks for it, except with p_show_contours, where each
+    # contour is displayed with imshow() as it is found. HighGUI windows
+    # belong to the main thread so a caller on a worker thread must not
+    # set p_show_contours.
     @staticmethod
-    def filter_contours_limelight(p_thresholded, image_height, image_width, min_area, max_area):
+    def filter_contours_limelight(p_thresholded, image_height, image_width, min_area, max_area, p_buffers=None,
+                                  p_show_contours=False):
         contours, _ = cv2.findContours(p_thresholded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         filtered_contours = []
 
-        # Draw on an all-black background; drawContours requires a BGR image.
-        filtered_bgr = np.zeros((image_height, image_width, 3), dtype=np.uint8)
+        if p_show_contours:
+            filtered_binary = ImageUtils._get_blank_binary(image_height, image_width, p_buffers)
 
         num_below_min_area = 0
         num_above_max_area = 0
         num_filtered = 0
+        largest_filtered_contour = np.array([[]])
+        largest_filtered_area = -1.0
         for i, contour in enumerate(contours):
             oneContourArea = cv2.contourArea(contours[i])
             if oneContourArea < min_area:
@@ -108,31 +222,179 @@ class ImageUtils:
             # Got a contour whose area is in range.
             num_filtered = num_filtered + 1
             filtered_contours.append(contours[i])
-            cv2.drawContours(filtered_bgr, contours, i, (255, 255, 255), cv2.FILLED)
-            if platform.system() == "Windows":
-                cv2.imshow("Found contour ", filtered_bgr)
+
+            # The Limelight runtime wants the largest contour.
+            if oneContourArea > largest_filtered_area:
+                largest_filtered_area = oneContourArea
+                largest_filtered_contour = contours[i]
+
+            if p_show_contours:
+                cv2.drawContours(filtered_binary, contours, i, 255, cv2.FILLED)
+                cv2.imshow("Found contour ", filtered_binary)
                 cv2.waitKey(0)
 
-        # Convert the BGR image to grayscale, which in our case should be binary.
-        filtered_binary = cv2.cvtColor(filtered_bgr, cv2.COLOR_BGR2GRAY)
+        # Draw the filtered contours on an all-black background.
+        def build_filtered_binary():
+            filtered_binary = ImageUtils._get_blank_binary(image_height, image_width, p_buffers)
+            cv2.drawContours(filtered_binary, filtered_contours, -1, 255, cv2.FILLED)
+            return filtered_binary
+
+        return ImageUtils.FilteredContoursRecordLimelight(len(contours), num_below_min_area, num_above_max_area,
+                                                          largest_filtered_contour,
+                                                          filtered_binary if p_show_contours else build_filtered_binary,
+                                                          filtered_contours=filtered_contours)
+
+    @staticmethod
+    def _get_blank_binary(image_height, image_width, p_buffers):
+        if p_buffers is None:
+            return np.zeros((image_height, image_width), dtype=np.uint8)
+
+        blank_binary = p_buffers.get("filtered_binary", (image_height, image_width))
+        blank_binary.fill(0)
+        return blank_binary
+
+    # An alternative to filter_contours_limelight that makes a single
+    # connectedComponentsWithStats pass over the thresholded image and
+    # filters all of the components at once with NumPy. Only the
+    # largest surviving component is turned into a contour and the
+    # filtered binary image is only built if the caller asks for it.
+    #
+    # The area of a component is its pixel count, which is slightly
+    # larger than the cv2.contourArea of its outline. The aspect ratio
+    # (long side/short side) is taken from the second-order moments of
+    # each component that passes the area test, so it does not depend
+    # on the rotation of the sample. Pass min_aspect_ratio=None to skip
+    # the aspect ratio test.
+    @staticmethod
+    def filter_components_limelight(p_thresholded, min_area, max_area,
+                                    min_aspect_ratio=None, max_aspect_ratio=None, p_buffers=None):
+        labels_shape = p_thresholded.shape[:2]
+        labels = None if p_buffers is None else p_buffers.get("component_labels", labels_shape, np.int32)
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+            p_thresholded, 8, cv2.CV_32S, cv2.CCL_GRANA, labels=labels)
+
+        # Label 0 is the background.
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        below_min_area = areas < min_area
+        above_max_area = areas > max_area
+        candidate_labels = np.flatnonzero(~(below_min_area | above_max_area)) + 1
+
+        num_outside_aspect_ratio = 0
+        if min_aspect_ratio is not None and candidate_labels.size > 0:
+            aspect_ratios = np.array([ImageUtils._get_component_aspect_ratio(labels, stats, label)
+                                      for label in candidate_labels])
+            in_range = (aspect_ratios >= min_aspect_ratio) & (aspect_ratios <= max_aspect_ratio)
+            num_outside_aspect_ratio = int(candidate_labels.size - np.count_nonzero(in_range))
+            candidate_labels = candidate_labels[in_range]
 
         # The Limelight runtime wants the largest contour.
-        if filtered_contours:
-            largest_filtered_contour = max(filtered_contours, key=cv2.contourArea)
+        if candidate_labels.size > 0:
+            largest_label = candidate_labels[np.argmax(stats[candidate_labels, cv2.CC_STAT_AREA])]
+            largest_filtered_contour = ImageUtils._get_component_contour(labels, stats, largest_label)
         else:
             largest_filtered_contour = np.array([[]])
 
-        return ImageUtils.FilteredContoursRecordLimelight(len(contours), num_below_min_area, num_above_max_area,
-                                                          largest_filtered_contour, filtered_binary)
+        def build_filtered_binary():
+            label_lut = np.zeros(num_labels, dtype=np.uint8)
+            label_lut[candidate_labels] = 255
+            filtered_binary = None if p_buffers is None else p_buffers.get("filtered_binary", labels_shape)
+            return np.take(label_lut, labels, out=filtered_binary)
+
+        def build_filtered_contours():
+            return [ImageUtils._get_component_contour(labels, stats, label) for label in candidate_labels]
+
+        return ImageUtils.FilteredContoursRecordLimelight(num_labels - 1, int(np.count_nonzero(below_min_area)),
+                                                          int(np.count_nonzero(above_max_area)),
+                                                          largest_filtered_contour, build_filtered_binary,
+                                                          num_outside_aspect_ratio, build_filtered_contours)
 
+    @staticmethod
+    def _get_component_mask(p_labels, p_stats, p_label):
+        x, y, w, h = p_stats[p_label, :4]
+        return cv2.compare(p_labels[y:y + h, x:x + w], int(p_label), cv2.CMP_EQ), (int(x), int(y))
+
+    @staticmethod
+    def _get_component_aspect_ratio(p_labels, p_stats, p_label):
+        component_mask, _ = ImageUtils._get_component_mask(p_labels, p_stats, p_label)
+        moments = cv2.moments(component_mask, binaryImage=True)
+        common = (moments["mu20"] + moments["mu02"]) / 2.0
+        spread = np.sqrt(((moments["mu20"] - moments["mu02"]) / 2.0) ** 2 + moments["mu11"] ** 2)
+        if common - spread <= 0:
+            return np.inf  # a line of pixels
+        return np.sqrt((common + spread) / (common - spread))
+
+    @staticmethod
+    def _get_component_contour(p_labels, p_stats, p_label):
+        component_mask, offset = ImageUtils._get_component_mask(p_labels, p_stats, p_label)
+        contours, _ = cv2.findContours(component_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        return max(contours, key=cv2.contourArea)
+
+    # The filtered_binary_output and the list of all filtered_contours
+    # may be supplied either as values or as functions that build the
+    # values the first time they are needed.
     class FilteredContoursRecordLimelight:
         def __init__(self, num_unfiltered_contours, num_below_min_area, num_above_max_area,
-                     largest_filtered_contour, filtered_binary_output):
+                     largest_filtered_contour, filtered_binary_output, num_outside_aspect_ratio=0,
+                     filtered_contours=None):
             self.numUnfilteredContours = num_unfiltered_contours
             self.numBelowMinArea = num_below_min_area
             self.numAboveMaxArea = num_above_max_area
+            self.numOutsideAspectRatio = num_outside_aspect_ratio
             self.largest_filtered_contour = largest_filtered_contour
-            self.filtered_binary_output = filtered_binary_output
+            self._filtered_binary_output = filtered_binary_output
+            self._filtered_contours = filtered_contours
+
+        @property
+        def filtered_binary_output(self):
+            if callable(self._filtered_binary_output):
+                self._filtered_binary_output = self._filtered_binary_output()
+            return self._filtered_binary_output
+
+        @property
+        def filtered_contours(self):
+            if callable(self._filtered_contours):
+                self._filtered_contours = self._filtered_contours()
+            return self._filtered_contours
+
+
+#################################################################
+# FrameBuffers.py
+#################################################################
+# Scratch images that persist from one frame to the next so that
+# the per-frame OpenCV calls can write into them through their
+# dst= parameters instead of allocating new images every frame.
+#
+# Each named buffer owns a flat block of memory; get() returns a
+# contiguous view of the requested shape at the front of that
+# block. The block is only reallocated when a request needs more
+# memory than the block holds, e.g. when the camera resolution is
+# increased, so smaller requests such as a region of interest reuse
+# the same memory.
+#
+# The counters let a caller check that a steady stream of frames of
+# the same size causes no new allocations.
+class FrameBuffers:
+    def __init__(self):
+        self._storage = {}
+        self.num_requests = 0
+        self.num_allocations = 0
+        self.num_allocated_bytes = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        self.num_requests += 1
+        dtype = np.dtype(dtype)
+        num_bytes = int(np.prod(shape)) * dtype.itemsize
+        storage = self._storage.get(name)
+        if storage is None or storage.size < num_bytes:
+            storage = np.empty(num_bytes, dtype=np.uint8)
+            self._storage[name] = storage
+            self.num_allocations += 1
+            self.num_allocated_bytes += num_bytes
+
+        return storage[:num_bytes].view(dtype).reshape(shape)
+
+    def clear(self):
+        self._storage.clear()
 
 
 #################################################################
@@ -164,6 +426,392 @@ class SampleParameters:
     MIN_SAMPLE_ASPECT_RATIO = 1.6
     MAX_SAMPLE_ASPECT_RATIO = 3.0
 
+    # Weights of the parts of a candidate's score, see
+    # SampleRecognition.rank_candidates.
+    CANDIDATE_AREA_WEIGHT = 1.0
+    CANDIDATE_ASPECT_RATIO_WEIGHT = 1.0
+    CANDIDATE_CENTER_WEIGHT = 1.0
+    CANDIDATE_ALLIANCE_COLOR_WEIGHT = 0.5
+
+#################################################################
+# PipelineOptions.py
+#################################################################
+# Run-time choices for the recognition pipeline. Like the values in
+# SampleParameters these are class attributes that a test program
+# may change before it calls runPipeline.
+class PipelineOptions:
+    # Show intermediate images with imshow() and wait for a key.
+    SHOW_DEBUG_IMAGES = platform.system() == "Windows"
+
+    class ContourFilter(Enum):
+        CONTOURS = 1  # ImageUtils.filter_contours_limelight
+        COMPONENTS = 2  # ImageUtils.filter_components_limelight, includes aspect ratio
+
+    CONTOUR_FILTER = ContourFilter.CONTOURS
+
+    # Where the timing buffer is written when the robot asks for it;
+    # see LLRobot.StageTiming.
+    STAGE_TIMING_DUMP_FILE = "stage_timings.csv"
+
+    # Run recognition on a background thread; see AsyncPipeline.
+    ASYNC_PIPELINE = False
+    ASYNC_MAX_RESULT_AGE_SECONDS = 0.25  # never return a result for a frame that arrived longer ago than this
+
+    # If set, every frame that runPipeline sees is appended to this
+    # file together with its llrobot input and llpython output; see
+    # FrameRecorder and runPipeline_Replay.py.
+    CAPTURE_FILE = None
+
+    # Look for samples of the alliance color as well as neutral (yellow)
+    # samples and target the largest. The colors are labeled by
+    # SampleColorClassifier in one pass and the per-color chains run on a
+    # persistent pool of COLOR_WORKERS threads (1 runs them in turn on
+    # the calling thread). The pyramid search is not used in this mode.
+    MULTI_COLOR = False
+    COLOR_WORKERS = 2
+
+    # The black frame check converts every BLACK_FRAME_ROW_STRIDE'th row
+    # to gray before it converts the whole frame; see
+    # ImageUtils.is_black_image.
+    BLACK_FRAME_ROW_STRIDE = 16
+
+    # Return the previous result without running recognition while
+    # the frame has not changed; see ResultCache.
+    RESULT_CACHE = False
+    RESULT_CACHE_THUMBNAIL_SIZE = (64, 48)  # width, height of the sampled thumbnail
+    RESULT_CACHE_PIXEL_THRESHOLD = 24  # a thumbnail value that differs by more than this has changed
+    RESULT_CACHE_CHANGED_FRACTION = 0.01  # the frame has changed if more than this fraction of values has
+    RESULT_CACHE_MAX_AGE_SECONDS = 0.25  # run recognition again at least this often
+    RESULT_CACHE_TARGET_PADDING = 0.25  # any change this fraction of the long side around the cached sample misses
+
+    # Search a window around the previous detection before searching
+    # the full frame; see SampleTracker. Not used on frames that ask for
+    # candidates (llrobot[3]).
+    ROI_TRACKING = False
+    ROI_PADDING = 0.5  # fraction of the long side of the previous sample added on every side
+    ROI_TIMEOUT_SECONDS = 0.5  # go back to the full frame if the last hit is older than this
+
+    # Coarse-to-fine search of the full frame: find the best candidate
+    # in an image downscaled by PYRAMID_SCALE and then refine it at
+    # full resolution in a window around the candidate. 1 turns the
+    # pyramid off.
+    PYRAMID_SCALE = 1
+    PYRAMID_AREA_TOLERANCE = 0.1  # widen the downscaled area limits by this fraction
+    PYRAMID_CANDIDATE_AREA_RATIO = 0.8  # refine every candidate at least this fraction of the largest
+    PYRAMID_INTERPOLATION = cv2.INTER_NEAREST  # INTER_AREA is smoother but much slower at scale 4
+
+#################################################################
+# StageTimer.py
+#################################################################
+# Optional timing of the stages of the pipeline. When stage_timer
+# (below) is None, which is the default, the only cost is the test
+# for None. Timing is turned on either by the robot through llrobot
+# (see runPipeline) or by a program such as a benchmark that installs
+# its own StageTimer with set_stage_timer().
+#
+# The times for the frame in progress are added up in a short list;
+# at the end of each frame runPipeline copies them into one row of a
+# ring buffer that is allocated once. The oldest frames are
+# overwritten when the buffer is full. There is a single writer (the
+# thread that runs the pipeline) so no locks are needed: the robot's
+# timing requests are applied on that thread, set_stage_timer() must
+# only be called from it (or while the pipeline is not running), and
+# each function reads stage_timer once so that its start()/stop()
+# pairs always use the same timer.
+#
+# A stage may run more than once per frame (for example thresholding
+# in several search windows); its times are added together.
+#
+# PipelineStage is an IntEnum so that a stage can index the list of
+# times directly. A start()/stop() pair costs less than a microsecond
+# on a desktop, most of it in the two reads of the clock.
+class PipelineStage(IntEnum):
+    BLACK_FRAME_CHECK = 0
+    THRESHOLD = 1
+    CONTOUR_FILTER = 2  # filter_contours_limelight/filter_components_limelight
+    ROTATED_RECT = 3  # minAreaRect and get_sample_orientation_and_ftc_angle
+    ANNOTATION = 4  # copy of the image and the drawn target
+    PERFORM_RECOGNITION = 5  # all of the recognition for one frame
+    FRAME = 6  # all of runPipeline
+    COLOR_DETECTION = 7  # SampleColorClassifier and all per-color chains with PipelineOptions.MULTI_COLOR
+    RESULT_CACHE = 8  # thumbnail of the frame and comparison with the cached frame
+    CAPTURE = 9  # writing to PipelineOptions.CAPTURE_FILE; after end_frame, so counted with the next frame (not async)
+
+
+class StageTimer:
+    CAPACITY = 512  # frames
+    SUMMARY_INTERVAL = 64  # frames between recalculations of get_frame_time_summary
+
+    def __init__(self, p_capacity=CAPACITY):
+        self.capacity = p_capacity
+        self.num_frames = 0  # total number of frames recorded, including those overwritten
+        self._stage_ns = np.zeros((p_capacity, len(PipelineStage)), dtype=np.int64)
+        self._frame_start_ns = np.zeros(p_capacity, dtype=np.int64)
+        self._frame_ns = [0] * len(PipelineStage)
+        self._summary = None
+        self._summary_num_frames = 0
+
+    @staticmethod
+    def start():
+        return time.perf_counter_ns()
+
+    def stop(self, p_stage, p_start_ns):
+        self._frame_ns[p_stage] += time.perf_counter_ns() - p_start_ns
+
+    def end_frame(self, p_frame_start_ns=0):
+        row = self.num_frames % self.capacity
+        self._stage_ns[row] = self._frame_ns
+        self._frame_start_ns[row] = p_frame_start_ns
+        self.num_frames += 1
+        for stage_index in range(len(self._frame_ns)):
+            self._frame_ns[stage_index] = 0
+
+    def _get_rows(self):
+        if self.num_frames <= self.capacity:
+            return np.arange(self.num_frames)
+        return np.arange(self.num_frames, self.num_frames + self.capacity) % self.capacity
+
+    # Returns an array of shape (number of frames in the buffer, number
+    # of stages) in milliseconds, oldest frame first.
+    def get_frame_ms(self):
+        return self._stage_ns[self._get_rows()] / 1.0e6
+
+    # Returns the number of frames in the buffer and the mean, median,
+    # 95th percentile and maximum of their frame times in milliseconds.
+    # The percentiles over a full buffer take a few hundred microseconds
+    # on the Limelight, too much for every frame, so once there are
+    # SUMMARY_INTERVAL frames the summary is only recalculated every
+    # SUMMARY_INTERVAL frames and the same values are returned in
+    # between. Before that it is recalculated on every new frame, which
+    # is cheap for so few frames, so the first summaries aren't just the
+    # cold first frame.
+    def get_frame_time_summary(self):
+        if self._summary is not None and self.num_frames == self._summary_num_frames:
+            return self._summary
+        if (self._summary is not None and self._summary_num_frames >= self.SUMMARY_INTERVAL and
+                self.num_frames - self._summary_num_frames < self.SUMMARY_INTERVAL):
+            return self._summary
+
+        # The order of the frames doesn't matter here.
+        frame_ms = np.sort(self._stage_ns[:min(self.num_frames, self.capacity), PipelineStage.FRAME.value]) / 1.0e6
+        if frame_ms.size == 0:
+            self._summary = [0, 0.0, 0.0, 0.0, 0.0]
+        else:
+            self._summary = [frame_ms.size, float(np.mean(frame_ms)), self._get_percentile(frame_ms, 50),
+                             self._get_percentile(frame_ms, 95), float(frame_ms[-1])]
+        self._summary_num_frames = self.num_frames
+        return self._summary
+
+    # The same as np.percentile (linear interpolation) for sorted values,
+    # without its overhead.
+    @staticmethod
+    def _get_percentile(p_sorted_values, p_percentile):
+        position = p_percentile / 100.0 * (p_sorted_values.size - 1)
+        lower = int(position)
+        upper = min(lower + 1, p_sorted_values.size - 1)
+        return float(p_sorted_values[lower] + (p_sorted_values[upper] - p_sorted_values[lower]) * (position - lower))
+
+    # Writes the buffer to a CSV file, one row per frame, oldest first,
+    # with the frame start (perf_counter_ns) and the time of each stage
+    # in milliseconds.
+    def dump(self, p_path):
+        rows = self._get_rows()
+        frame_start_ms = (self._frame_start_ns[rows] / 1.0e6).reshape(-1, 1)
+        header = ",".join(["frame_start_ms"] + [stage.name for stage in PipelineStage])
+        np.savetxt(p_path, np.hstack((frame_start_ms, self._stage_ns[rows] / 1.0e6)),
+                   delimiter=",", header=header, comments="", fmt="%.4f")
+
+
+stage_timer = None
+
+def set_stage_timer(p_stage_timer):
+    global stage_timer
+    stage_timer = p_stage_timer
+
+#################################################################
+# SampleColorClassifier.py
+#################################################################
+# Labels every pixel of a BGR image as one of the values of
+# SampleRecognition.SampleColor in a single vectorized pass.
+#
+# The BGR color cube is divided into bins of QUANTIZATION_STEP
+# levels per channel and every bin is classified once, when the
+# classifier is built, with the same rules that the thresholding
+# code applies to the full image:
+#   YELLOW - green channel > GREEN_CHANNEL_THRESHOLD_LOW
+#   RED    - HSV inRange for RED_HSV_* (with wrap-around at 180)
+#   BLUE   - HSV inRange for BLUE_HSV_*
+# If a bin satisfies more than one rule the first one in the list
+# above wins.
+#
+# Per frame the work is one cv2.LUT per channel, from the channel
+# value to its bin number scaled by the stride of the channel in the
+# flattened table, two additions and one lookup from the bin index to
+# the color. So the cost stays the same no matter how many colors we
+# look for, and there is no HSV conversion of the full image.
+#
+# The bin index is 16 bits, which limits the table to 65536 bins, so
+# the smallest step is 7. The green threshold is always a bin boundary
+# so yellow matches threshold() exactly. A bin that lies only partly
+# inside the RED or BLUE HSV range is labeled AMBIGUOUS and its pixels
+# are gathered, converted to HSV and passed through inRange(), so the
+# labels are the same as thresholding the HSV image; only the pixels
+# near a hue/sat/val boundary pay for the conversion.
+class SampleColorClassifier:
+    QUANTIZATION_STEP = 8  # 32 bins per channel (33 for green), 33792 in all
+    AMBIGUOUS = 255  # label of a bin that is only partly RED or BLUE, never returned by classify()
+
+    def __init__(self, p_quantization_step=QUANTIZATION_STEP):
+        self.quantization_step = p_quantization_step
+
+        # Bin boundaries per channel; the green channel gets an extra
+        # boundary just above the threshold because THRESH_BINARY
+        # selects values > threshold.
+        uniform_edges = list(range(0, 256, p_quantization_step))
+        b_edges = np.array(uniform_edges)
+        g_edges = np.array(sorted(set(uniform_edges) | {SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW + 1}))
+        r_edges = np.array(uniform_edges)
+        if len(b_edges) * len(g_edges) * len(r_edges) > 65536:
+            raise ValueError("Quantization step " + str(p_quantization_step) + " is too small for a 16-bit bin index")
+
+        # Map each 8-bit channel value to its bin number scaled by the
+        # stride of the channel in the flattened color table.
+        all_values = np.arange(256)
+        r_stride = 1
+        g_stride = len(r_edges)
+        b_stride = len(g_edges) * len(r_edges)
+        self._b_lut = ((np.searchsorted(b_edges, all_values, side="right") - 1) * b_stride).astype(np.uint16)
+        self._g_lut = ((np.searchsorted(g_edges, all_values, side="right") - 1) * g_stride).astype(np.uint16)
+        self._r_lut = ((np.searchsorted(r_edges, all_values, side="right") - 1) * r_stride).astype(np.uint16)
+
+        self._class_lut = self._build_class_lut(b_edges, g_edges, r_edges)
+
+    @staticmethod
+    def _build_class_lut(p_b_edges, p_g_edges, p_r_edges):
+        # Count the colors of each bin that are RED and BLUE, one bin of
+        # the blue channel (every green and red value) at a time. A bin
+        # where all of its colors pass is RED or BLUE, one where some
+        # pass is AMBIGUOUS and is resolved per pixel in classify().
+        table_shape = (len(p_b_edges), len(p_g_edges), len(p_r_edges))
+        red_counts = np.empty(table_shape, dtype=np.int64)
+        blue_counts = np.empty(table_shape, dtype=np.int64)
+        b_bounds = np.append(p_b_edges, 256)
+        g_values, r_values = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing="ij")
+        for b_bin in range(len(p_b_edges)):
+            b_values = np.arange(b_bounds[b_bin], b_bounds[b_bin + 1], dtype=np.uint8)
+            # A one-row BGR "image" of every color in the bin.
+            bin_colors = np.stack(np.broadcast_arrays(b_values[:, np.newaxis, np.newaxis], g_values, r_values),
+                                  axis=-1).reshape(1, -1, 3)
+            bin_hsv = cv2.cvtColor(bin_colors, cv2.COLOR_BGR2HSV)
+            for counts, prefix in ((red_counts, "RED_HSV_"), (blue_counts, "BLUE_HSV_")):
+                passed = ImageUtils.apply_inRange(bin_hsv, getattr(SampleParameters, prefix + "HUE_LOW"),
+                                                  getattr(SampleParameters, prefix + "HUE_HIGH"),
+                                                  getattr(SampleParameters, prefix + "SAT_THRESHOLD_LOW"),
+                                                  getattr(SampleParameters, prefix + "VAL_THRESHOLD_LOW"))
+                passed = (passed.reshape(len(b_values), 256, 256) != 0).sum(axis=0)
+                counts[b_bin] = np.add.reduceat(np.add.reduceat(passed, p_g_edges, axis=0), p_r_edges, axis=1)
+
+        bin_sizes = [np.diff(np.append(edges, 256)) for edges in (p_b_edges, p_g_edges, p_r_edges)]
+        bin_sizes = (bin_sizes[0][:, np.newaxis, np.newaxis] * bin_sizes[1][np.newaxis, :, np.newaxis] *
+                     bin_sizes[2][np.newaxis, np.newaxis, :]).ravel()
+        red_counts = red_counts.ravel()
+        blue_counts = blue_counts.ravel()
+
+        # Yellow only depends on the lower bound of the green bin, which
+        # makes it exact.
+        yellow_green_bins = p_g_edges > SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW
+        yellow = np.broadcast_to(yellow_green_bins[np.newaxis, :, np.newaxis], table_shape).ravel()
+
+        class_lut = np.full(red_counts.size, SampleRecognition.SampleColor.NONE.value, dtype=np.uint8)
+        class_lut[(red_counts > 0) | (blue_counts > 0)] = SampleColorClassifier.AMBIGUOUS
+        class_lut[(blue_counts == bin_sizes) & (red_counts == 0)] = SampleRecognition.SampleColor.BLUE.value
+        class_lut[red_counts == bin_sizes] = SampleRecognition.SampleColor.RED.value
+        class_lut[yellow] = SampleRecognition.SampleColor.YELLOW.value
+        return class_lut
+
+    # Returns a single-channel image of SampleColor values, one per pixel.
+    # If p_buffers (FrameBuffers) is supplied the intermediate images and
+    # the returned labels are taken from it.
+    def classify(self, p_bgr_image, p_buffers=None):
+        image_shape = p_bgr_image.shape[:2]
+        if p_buffers is None:
+            channels = cv2.split(p_bgr_image)
+            bin_index = cv2.LUT(channels[0], self._b_lut)
+            channel_index = cv2.LUT(channels[1], self._g_lut)
+            labels = None
+        else:
+            channels = cv2.split(p_bgr_image, [p_buffers.get("classifier_" + name, image_shape)
+                                               for name in ("blue", "green", "red")])
+            bin_index = cv2.LUT(channels[0], self._b_lut,
+                                dst=p_buffers.get("classifier_bin_index", image_shape, np.uint16))
+            channel_index = cv2.LUT(channels[1], self._g_lut,
+                                    dst=p_buffers.get("classifier_channel_index", image_shape, np.uint16))
+            labels = p_buffers.get("classifier_labels", image_shape)
+
+        cv2.add(bin_index, channel_index, dst=bin_index)
+        cv2.add(bin_index, cv2.LUT(channels[2], self._r_lut, dst=channel_index), dst=bin_index)
+        # Every index is in range; mode "clip" lets np.take write to out
+        # directly instead of through a temporary.
+        labels = np.take(self._class_lut, bin_index, out=labels, mode="clip")
+
+        # Pixels in a bin that straddles a RED or BLUE boundary are
+        # converted to HSV and thresholded on their own.
+        ambiguous = np.equal(labels, self.AMBIGUOUS,
+                             out=None if p_buffers is None else p_buffers.get("classifier_ambiguous", image_shape, np.bool_))
+        ambiguous_indices = np.flatnonzero(ambiguous)
+        if ambiguous_indices.size > 0:
+            if p_bgr_image.flags.c_contiguous:
+                ambiguous_pixels = np.take(p_bgr_image.reshape(-1, 3), ambiguous_indices, axis=0)
+            else:  # a search window
+                ambiguous_pixels = p_bgr_image[np.unravel_index(ambiguous_indices, image_shape)]
+            hsv = cv2.cvtColor(ambiguous_pixels.reshape(1, -1, 3), cv2.COLOR_BGR2HSV)
+            red = ImageUtils.apply_inRange(hsv, SampleParameters.RED_HSV_HUE_LOW, SampleParameters.RED_HSV_HUE_HIGH,
+                                           SampleParameters.RED_HSV_SAT_THRESHOLD_LOW,
+                                           SampleParameters.RED_HSV_VAL_THRESHOLD_LOW).ravel()
+            blue = ImageUtils.apply_inRange(hsv, SampleParameters.BLUE_HSV_HUE_LOW, SampleParameters.BLUE_HSV_HUE_HIGH,
+                                            SampleParameters.BLUE_HSV_SAT_THRESHOLD_LOW,
+                                            SampleParameters.BLUE_HSV_VAL_THRESHOLD_LOW).ravel()
+            resolved = np.full(ambiguous_indices.size, SampleRecognition.SampleColor.NONE.value, dtype=np.uint8)
+            resolved[blue != 0] = SampleRecognition.SampleColor.BLUE.value
+            resolved[red != 0] = SampleRecognition.SampleColor.RED.value
+            labels.reshape(-1)[ambiguous_indices] = resolved
+        return labels
+
+    # Returns a binary (0/255) mask for one SampleColor from the output
+    # of classify(), in p_dst if it is supplied.
+    @staticmethod
+    def get_color_mask(p_labels, p_sample_color, p_dst=None):
+        return cv2.compare(p_labels, p_sample_color.value, cv2.CMP_EQ, dst=p_dst)
+
+    # Classifies the image and returns a dictionary of binary masks
+    # keyed by SampleColor for YELLOW, RED, and BLUE.
+    def get_color_masks(self, p_bgr_image):
+        labels = self.classify(p_bgr_image)
+        return {color: self.get_color_mask(labels, color)
+                for color in (SampleRecognition.SampleColor.YELLOW,
+                              SampleRecognition.SampleColor.RED,
+                              SampleRecognition.SampleColor.BLUE)}
+
+
+# The classifier depends on SampleParameters, so build it on first
+# use and keep it for the life of the process; it is rebuilt if a
+# program such as a calibration tool changes one of the parameters
+# it was built from.
+_sample_color_classifier = None
+_sample_color_classifier_key = None
+
+def get_sample_color_classifier():
+    global _sample_color_classifier, _sample_color_classifier_key
+    classifier_key = (SampleColorClassifier.QUANTIZATION_STEP, SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW,
+                      SampleParameters.RED_HSV_HUE_LOW, SampleParameters.RED_HSV_HUE_HIGH,
+                      SampleParameters.RED_HSV_SAT_THRESHOLD_LOW, SampleParameters.RED_HSV_VAL_THRESHOLD_LOW,
+                      SampleParameters.BLUE_HSV_HUE_LOW, SampleParameters.BLUE_HSV_HUE_HIGH,
+                      SampleParameters.BLUE_HSV_SAT_THRESHOLD_LOW, SampleParameters.BLUE_HSV_VAL_THRESHOLD_LOW)
+    if _sample_color_classifier is None or classifier_key != _sample_color_classifier_key:
+        _sample_color_classifier = SampleColorClassifier()
+        _sample_color_classifier_key = classifier_key
+    return _sample_color_classifier
+
 #################################################################
 # OpenCVRotatedRect.py
 #################################################################
@@ -214,11 +862,32 @@ class SampleRecognition:
         COUNTER_CLOCKWISE = 3
         CLOCKWISE = 4
 
-    def __init__(self, p_alliance):
+    class SearchRegion(Enum):
+        FULL_FRAME = 1
+        ROI = 2
+        PYRAMID = 3
+
+    # What perform_recognition returns as the image for the Limelight's
+    # video stream. MINIMAL returns the input image itself, without a
+    # copy or any drawing; DEBUG also overlays the filtered binary
+    # image and every candidate contour of each search.
+    class OutputMode(Enum):
+        ANNOTATED = 0
+        MINIMAL = 1
+        DEBUG = 2
+
+    # p_buffers is an optional FrameBuffers object that is shared
+    # across frames; by default each SampleRecognition has its own.
+    def __init__(self, p_alliance, p_buffers=None):
         self.alliance = p_alliance
+        self.buffers = FrameBuffers() if p_buffers is None else p_buffers
+        self.color_buffers = {}  # FrameBuffers per SampleColor for PipelineOptions.MULTI_COLOR
         self.image_roi_height = 0.0
         self.image_roi_width = 0.0
         self.image_roi_center = (0.0, 0.0)
+        self._debug_overlays = None  # with OutputMode.DEBUG: (x, y, SampleColor, binary, contours)
+        self._candidates = None  # if candidates are requested: (SampleColor, contour in image coordinates)
+        self._candidate_keys = set()  # (SampleColor, bounding rectangle) of each of the _candidates
 
     class SampleRecognitionReturn:
         class RecognitionStatus(Enum):
@@ -229,7 +898,7 @@ class SampleRecognition:
             FAILURE = 500
 
         def __init__(self, status, color_value, ftc_angle, selected_sample_center_x, selected_sample_center_y,
-                     sample_contour, drawn_target):
+                     sample_contour, drawn_target, search_region=None, rotated_rect=None, candidates=None):
             self.status = status
             self.color_value = color_value
             self.ftc_angle = ftc_angle
@@ -237,6 +906,17 @@ class SampleRecognition:
             self.selected_sample_center_y = selected_sample_center_y
             self.sample_contour = sample_contour
             self.drawn_target = drawn_target
+            self.search_region = search_region  # SampleRecognition.SearchRegion
+            self.rotated_rect = rotated_rect  # OpenCVRotatedRect on success
+            self.candidates = candidates  # list of SampleCandidate, best first, if requested
+
+    class SampleCandidate:
+        def __init__(self, color_value, ftc_angle, center_x, center_y, score):
+            self.color_value = color_value
+            self.ftc_angle = ftc_angle
+            self.center_x = center_x
+            self.center_y = center_y
+            self.score = score
 
     # The x and y coordinates of the points of an OpenCV RotatedRect
     # are relative to 0,0 at the viewer's upper left. The points
@@ -274,10 +954,6 @@ class SampleRecognition:
     # The angle of both a perfectly vertical RotatedRectangle
     # and a perfectly horizontal RotatedRectangle is 90.0.
     def get_sample_orientation_and_ftc_angle(self, p_rotated_sample):
-        # Always get the box points for debugging.
-        box = cv2.boxPoints(p_rotated_sample.opencv_rotated_rect)
-        rect_points = np.int32(box)  # Integer values for pixel indices
-
         if p_rotated_sample.angle == 90.0:
             if p_rotated_sample.height < p_rotated_sample.width:
                 sample_orientation = self.SampleOrientation.VERTICAL
@@ -299,6 +975,8 @@ class SampleRecognition:
         else:
             # Got an angled square. This should not happen but we have to deal with it.
             # If point 1 y < point 0 y then the orientation is CCW, else CW.
+            box = cv2.boxPoints(p_rotated_sample.opencv_rotated_rect)
+            rect_points = np.int32(box)  # Integer values for pixel indices
             if round(rect_points[1][1]) < round(rect_points[0][1]):
                 sample_orientation = self.SampleOrientation.COUNTER_CLOCKWISE
                 ftc_angle = 90.0 - p_rotated_sample.angle
@@ -308,63 +986,697 @@ class SampleRecognition:
 
         return sample_orientation, ftc_angle
 
-    def perform_recognition(self, image):
+    # The same as get_sample_orientation_and_ftc_angle for an (N, 5)
+    # array of rotated rectangles (center x, center y, width, height,
+    # angle). Returns an array of SampleOrientation values, an array of
+    # FTC angles and the (N, 4, 2) int32 box points of the rectangles.
+    @staticmethod
+    def get_sample_orientations_and_ftc_angles(p_rotated_rects):
+        rects = np.asarray(p_rotated_rects, dtype=np.float64).reshape(-1, 5)
+        width = rects[:, 2]
+        height = rects[:, 3]
+        angle = rects[:, 4]
+        rect_points = np.int32(SampleRecognition.get_box_points(rects))
+
+        at_90 = angle == 90.0
+        horizontal = at_90 & (height > width)
+        vertical = at_90 & ~horizontal  # includes the square
+        counter_clockwise = ~at_90 & ((width > height) |
+                                      ((width == height) & (rect_points[:, 1, 1] < rect_points[:, 0, 1])))
+        conditions = [vertical, horizontal, counter_clockwise]
+
+        orientations = np.select(conditions, [SampleRecognition.SampleOrientation.VERTICAL.value,
+                                              SampleRecognition.SampleOrientation.HORIZONTAL.value,
+                                              SampleRecognition.SampleOrientation.COUNTER_CLOCKWISE.value],
+                                 SampleRecognition.SampleOrientation.CLOCKWISE.value)
+        ftc_angles = np.select(conditions, [0.0, 90.0, 90.0 - angle], -1 * angle)
+        return orientations, ftc_angles, rect_points
+
+    # cv2.boxPoints for an (N, 5) array of rotated rectangles, with the
+    # same float32 arithmetic as OpenCV's RotatedRect::points so that
+    # the int32 points are identical. OpenCV 4 reflects points 0 and 1
+    # through the center to get points 2 and 3; later versions compute
+    # them directly. The two can differ in the last bit, so the first
+    # call checks which one the installed OpenCV uses.
+    @staticmethod
+    def get_box_points(p_rotated_rects):
+        rects = np.asarray(p_rotated_rects, dtype=np.float32).reshape(-1, 5)
+        center_x = rects[:, 0]
+        center_y = rects[:, 1]
+        width = rects[:, 2]
+        height = rects[:, 3]
+        radians = rects[:, 4].astype(np.float64) * np.pi / 180.0
+        b = np.cos(radians).astype(np.float32) * np.float32(0.5)
+        a = np.sin(radians).astype(np.float32) * np.float32(0.5)
+
+        points = np.empty((len(rects), 4, 2), dtype=np.float32)
+        points[:, 0, 0] = center_x - a * height - b * width
+        points[:, 0, 1] = center_y + b * height - a * width
+        points[:, 1, 0] = center_x + a * height - b * width
+        points[:, 1, 1] = center_y - b * height - a * width
+        if _box_points_by_reflection():
+            points[:, 2, 0] = np.float32(2) * center_x - points[:, 0, 0]
+            points[:, 2, 1] = np.float32(2) * center_y - points[:, 0, 1]
+            points[:, 3, 0] = np.float32(2) * center_x - points[:, 1, 0]
+            points[:, 3, 1] = np.float32(2) * center_y - points[:, 1, 1]
+        else:
+            points[:, 2, 0] = center_x + a * height + b * width
+            points[:, 2, 1] = center_y - b * height + a * width
+            points[:, 3, 0] = center_x - a * height + b * width
+            points[:, 3, 1] = center_y + b * height + a * width
+        return points
+
+    # p_search_windows is an optional list of (x0, y0, x1, y1) rectangles
+    # in image coordinates; if it is supplied only those parts of the
+    # image are thresholded and filtered and the largest contour found
+    # in any of them is selected. A contour that touches the edge of its
+    # window may be cut off so it is not used; if no window yields a
+    # contour recognition fails and the caller should search the full
+    # frame.
+    #
+    # With p_num_candidates > 0 the return value also carries up to that
+    # many of the candidates that passed the area filter in the searched
+    # part of the image, ranked by rank_candidates.
+    def perform_recognition(self, image, p_search_windows=None, p_output_mode=OutputMode.ANNOTATED,
+                            p_num_candidates=0):
+        timer = stage_timer
         self.image_roi_height, self.image_roi_width = image.shape[:2]
         self.image_roi_center = (self.image_roi_width / 2.0, self.image_roi_height / 2.0)
-
-        ##**TODO In the real IntoTheDeep game you'd want to recognize
-        # both alliance and neutral (yellow) samples and combine the
-        # results to target the best sample to pick up. But in the
-        # interest of simplicity let's just look for the neutral
-        # samples.
-
-        # Demonstrate how to find the yellow samples by thresholding
-        # the green channel of the original BGR image.
-        b, g, r = cv2.split(image) # split the image into its BGR channels
-        thresholdedN = ImageUtils.apply_grayscale_threshold(g, SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW)
-        if platform.system() == "Windows":
-            cv2.imshow("ThrN", thresholdedN)
-            cv2.waitKey(0)
-
-        # Sanitize the thresholded neutral samples by eliminating contours
-        # that are below the minimum allowable area or above the maximum
-        # allowable area.
-        filteredN = ImageUtils.filter_contours_limelight(thresholdedN, self.image_roi_height, self.image_roi_width,
-                                                         SampleParameters.MIN_SAMPLE_AREA / 2.0,
-                                                         SampleParameters.MAX_SAMPLE_AREA)
+        self._debug_overlays = [] if p_output_mode == SampleRecognition.OutputMode.DEBUG else None
+        self._candidates = [] if p_num_candidates > 0 else None
+        self._candidate_keys.clear()
+
+        # In the real IntoTheDeep game you'd want to recognize both
+        # alliance and neutral (yellow) samples and combine the results
+        # to target the best sample to pick up. That is what
+        # PipelineOptions.MULTI_COLOR does; by default, in the interest
+        # of simplicity, let's just look for the neutral samples.
+        if p_search_windows is None:
+            search_region = SampleRecognition.SearchRegion.FULL_FRAME
+            sample_contour, sample_color = self._find_sample_contour(image, None)
+        else:
+            search_region = SampleRecognition.SearchRegion.ROI
+            sample_contour = np.array([[]])
+            sample_color = None
+            sample_area = -1.0
+            for search_window in p_search_windows:
+                window_contour, window_color = self._find_sample_contour(image, search_window)
+                if window_contour.size > 0:
+                    window_area = cv2.contourArea(window_contour)
+                    if window_area > sample_area:
+                        sample_area = window_area
+                        sample_contour = window_contour
+                        sample_color = window_color
 
         # Get a rotated rectangle from the largest contour.
         ret_status = self.SampleRecognitionReturn.RecognitionStatus.FAILURE
-        color_value = SampleRecognition.SampleColor.YELLOW.value
-        drawn_targets = np.copy(image)
+        if sample_color is not None:
+            color_value = sample_color.value
+        elif PipelineOptions.MULTI_COLOR:
+            color_value = SampleRecognition.SampleColor.NONE.value
+        else:
+            color_value = SampleRecognition.SampleColor.YELLOW.value
         ftc_angle = 0.0
         sample_center_x = 0
         sample_center_y = 0
+        rotated_sample = None
 
         # Make sure we found at least one contour.
-        if filteredN.largest_filtered_contour.size > 0:
+        if sample_contour.size > 0:
+            if timer is not None:
+                stage_start = timer.start()
+
             ret_status = self.SampleRecognitionReturn.RecognitionStatus.SUCCESS
-            one_rotated_rect = cv2.minAreaRect(filteredN.largest_filtered_contour)
+            one_rotated_rect = cv2.minAreaRect(sample_contour)
             rotated_sample = OpenCVRotatedRect(one_rotated_rect)
 
             # From the OpenCV RotatedRect determine the orientation and
             # FTC angle of the sample.
             sample_orientation, ftc_angle = self.get_sample_orientation_and_ftc_angle(rotated_sample)
-            print("Sample orientation: " + str(sample_orientation) + ", FTC angle " + str(ftc_angle))
+            pipeline_log.debug("Sample orientation: %s, FTC angle %s", sample_orientation, ftc_angle)
 
             sample_center_x = rotated_sample.center_x
             sample_center_y = rotated_sample.center_y
-            points = cv2.boxPoints(rotated_sample.opencv_rotated_rect)
-            points = np.int32(points)
+            if timer is not None:
+                timer.stop(PipelineStage.ROTATED_RECT, stage_start)
+
+        if p_output_mode == SampleRecognition.OutputMode.MINIMAL:
+            drawn_targets = image
+        else:
+            if timer is not None:
+                stage_start = timer.start()
 
-            # Draw the rotated rectangle around the sample contour.
-            cv2.drawContours(drawn_targets, [points], 0, (0, 255, 0), 2)
+            drawn_targets = self.buffers.get("drawn_targets", image.shape)
+            np.copyto(drawn_targets, image)
+            if self._debug_overlays is not None:
+                self._draw_debug_overlays(drawn_targets)
+
+            if rotated_sample is not None:
+                points = cv2.boxPoints(rotated_sample.opencv_rotated_rect)
+                points = np.int32(points)
+
+                # Draw the rotated rectangle around the sample contour.
+                cv2.drawContours(drawn_targets, [points], 0, (0, 255, 0), 2)
+
+            if timer is not None:
+                timer.stop(PipelineStage.ANNOTATION, stage_start)
+
+        candidates = None
+        if self._candidates is not None:
+            candidates = self.rank_candidates(self._candidates)[:p_num_candidates]
 
         return self.SampleRecognitionReturn(ret_status,
                                             color_value, ftc_angle,
                                             sample_center_x,
                                             sample_center_y,
-                                            filteredN.largest_filtered_contour, drawn_targets)
+                                            sample_contour, drawn_targets,
+                                            search_region, rotated_sample, candidates)
+
+    # Scores each (SampleColor, contour) and returns a list of
+    # SampleCandidate, highest score first. The score is the weighted
+    # mean (SampleParameters.CANDIDATE_*_WEIGHT) of
+    #   area: the contour area as a fraction of MAX_SAMPLE_AREA
+    #   aspect ratio: 1 inside MIN/MAX_SAMPLE_ASPECT_RATIO of the
+    #     rotated rectangle, falling off in proportion outside it
+    #   center: 1 at image_roi_center, 0 at the corners
+    #   alliance color: 1 for the alliance color, 0 for yellow
+    def rank_candidates(self, p_candidates):
+        alliance_color = SampleRecognition.SampleColor[self.alliance.name]
+        max_center_distance = np.hypot(self.image_roi_center[0], self.image_roi_center[1])
+        weights = (SampleParameters.CANDIDATE_AREA_WEIGHT, SampleParameters.CANDIDATE_ASPECT_RATIO_WEIGHT,
+                   SampleParameters.CANDIDATE_CENTER_WEIGHT, SampleParameters.CANDIDATE_ALLIANCE_COLOR_WEIGHT)
+        total_weight = sum(weights)
+
+        if not p_candidates:
+            return []
+
+        rotated_rects = np.array([(center[0], center[1], size[0], size[1], angle)
+                                  for center, size, angle in (cv2.minAreaRect(contour) for _, contour in p_candidates)])
+        areas = np.array([cv2.contourArea(contour) for _, contour in p_candidates])
+        _, ftc_angles, _ = self.get_sample_orientations_and_ftc_angles(rotated_rects)
+
+        area_scores = np.minimum(areas / SampleParameters.MAX_SAMPLE_AREA, 1.0)
+        long_sides = np.maximum(rotated_rects[:, 2], rotated_rects[:, 3])
+        short_sides = np.minimum(rotated_rects[:, 2], rotated_rects[:, 3])
+        aspect_ratios = np.divide(long_sides, short_sides, out=np.zeros_like(long_sides), where=short_sides > 0)
+        aspect_ratio_scores = np.ones_like(aspect_ratios)
+        below = aspect_ratios < SampleParameters.MIN_SAMPLE_ASPECT_RATIO
+        above = aspect_ratios > SampleParameters.MAX_SAMPLE_ASPECT_RATIO
+        aspect_ratio_scores[below] = aspect_ratios[below] / SampleParameters.MIN_SAMPLE_ASPECT_RATIO
+        aspect_ratio_scores[above] = SampleParameters.MAX_SAMPLE_ASPECT_RATIO / aspect_ratios[above]
+        center_distances = np.hypot(rotated_rects[:, 0] - self.image_roi_center[0],
+                                    rotated_rects[:, 1] - self.image_roi_center[1])
+        center_scores = 1.0 - center_distances / max_center_distance
+        color_scores = np.array([1.0 if color == alliance_color else 0.0 for color, _ in p_candidates])
+
+        scores = (weights[0] * area_scores + weights[1] * aspect_ratio_scores +
+                  weights[2] * center_scores + weights[3] * color_scores) / total_weight
+        ranked = [SampleRecognition.SampleCandidate(color.value, float(ftc_angles[i]), float(rotated_rects[i, 0]),
+                                                    float(rotated_rects[i, 1]), float(scores[i]))
+                  for i, (color, _) in enumerate(p_candidates)]
+
+        # Stable, so equal scores keep the order they were found in.
+        ranked.sort(key=lambda candidate: candidate.score, reverse=True)
+        return ranked
+
+    # Returns the largest contour of a sample in the full image or in
+    # p_search_window, in full image coordinates, or an empty array,
+    # and the SampleColor of the sample (None if there is no contour).
+    # Only neutral (yellow) samples are considered unless
+    # PipelineOptions.MULTI_COLOR is set.
+    def _find_sample_contour(self, image, p_search_window):
+        if p_search_window is None:
+            search_image = image
+        else:
+            search_x, search_y, search_x1, search_y1 = p_search_window
+            search_image = image[search_y:search_y1, search_x:search_x1]
+
+        if PipelineOptions.MULTI_COLOR:
+            color_records = self._find_multi_color_records(search_image)
+        else:
+            color_records = [(SampleRecognition.SampleColor.YELLOW,
+                              self._find_color_contour(search_image, None, SampleRecognition.SampleColor.YELLOW,
+                                                       self.buffers, False))]
+
+        # The largest contour of any color; on a tie the first color wins.
+        sample_contour = np.array([[]])
+        sample_color = None
+        sample_area = -1.0
+        for color, filtered in color_records:
+            contour = filtered.largest_filtered_contour
+            if contour.size > 0:
+                area = cv2.contourArea(contour) if len(color_records) > 1 else 0.0
+                if area > sample_area:
+                    sample_area = area
+                    sample_contour = contour
+                    sample_color = color
+
+        if self._debug_overlays is not None:
+            # The filters' scratch buffers are reused by the next search
+            # so take copies now.
+            origin_x, origin_y = (0, 0) if p_search_window is None else p_search_window[:2]
+            for color, filtered in color_records:
+                self._debug_overlays.append((origin_x, origin_y, color, filtered.filtered_binary_output.copy(),
+                                             list(filtered.filtered_contours)))
+
+        if self._candidates is not None:
+            self._add_candidates(image, p_search_window, color_records)
+
+        if sample_contour.size == 0:
+            return sample_contour, None
+
+        if p_search_window is not None:
+            search_height, search_width = search_image.shape[:2]
+            if self._touches_search_window_edge(sample_contour, search_width, search_height,
+                                                p_search_window, image.shape):
+                return np.array([[]]), None
+            sample_contour = sample_contour + np.array([search_x, search_y], dtype=sample_contour.dtype)
+
+        return sample_contour, sample_color
+
+    # Keeps every filtered contour of every color, in image coordinates,
+    # except those that may have been cut off by the search window. A
+    # sample that lies in more than one search window is kept once.
+    def _add_candidates(self, image, p_search_window, p_color_records):
+        for color, filtered in p_color_records:
+            for contour in filtered.filtered_contours:
+                if p_search_window is not None:
+                    search_x, search_y, search_x1, search_y1 = p_search_window
+                    if self._touches_search_window_edge(contour, search_x1 - search_x, search_y1 - search_y,
+                                                        p_search_window, image.shape):
+                        continue
+                    contour = contour + np.array([search_x, search_y], dtype=contour.dtype)
+
+                candidate_key = (color, cv2.boundingRect(contour))
+                if candidate_key in self._candidate_keys:
+                    continue
+                self._candidate_keys.add(candidate_key)
+                self._candidates.append((color, contour))
+
+    # The colors of the samples this alliance may pick up, alliance
+    # color first so that it wins a tie.
+    def get_target_colors(self):
+        return SampleRecognition.SampleColor[self.alliance.name], SampleRecognition.SampleColor.YELLOW
+
+    # Runs the per-color chains for the target colors, concurrently if
+    # there is more than one worker, and returns a list of (SampleColor,
+    # FilteredContoursRecordLimelight) in the order of the target colors.
+    def _find_multi_color_records(self, search_image):
+        timer = stage_timer
+        if timer is not None:
+            stage_start = timer.start()
+
+        # One pass of the classifier labels the pixels of every color;
+        # each chain takes its mask from the labels.
+        labels = get_sample_color_classifier().classify(search_image, self.buffers)
+        target_colors = self.get_target_colors()
+        color_executor = get_color_executor()
+        if color_executor is None:
+            color_records = [self._find_color_contour(search_image, labels, color,
+                                                      self._get_color_buffers(color), False)
+                             for color in target_colors]
+        else:
+            futures = [color_executor.submit(self._find_color_contour, search_image, labels, color,
+                                             self._get_color_buffers(color), True)
+                       for color in target_colors]
+            color_records = [future.result() for future in futures]
+
+        if timer is not None:
+            timer.stop(PipelineStage.COLOR_DETECTION, stage_start)
+        return list(zip(target_colors, color_records))
+
+    # Tints the filtered binary image of each search in the color of
+    # the sample it was looking for and outlines every candidate.
+    def _draw_debug_overlays(self, p_drawn_targets):
+        for origin_x, origin_y, color, binary, contours in self._debug_overlays:
+            height, width = binary.shape[:2]
+            region = p_drawn_targets[origin_y:origin_y + height, origin_x:origin_x + width]
+            cv2.add(region, DEBUG_OVERLAY_TINTS[color], dst=region, mask=binary)
+            cv2.drawContours(region, contours, -1, (255, 0, 255), 1)
+
+    # Each color has its own scratch buffers so that the chains can run
+    # at the same time.
+    def _get_color_buffers(self, p_color):
+        color_buffers = self.color_buffers.get(p_color)
+        if color_buffers is None:
+            color_buffers = FrameBuffers()
+            self.color_buffers[p_color] = color_buffers
+        return color_buffers
+
+    # The chain for one color: threshold, then filter the contours.
+    # Returns the FilteredContoursRecordLimelight, whose contours are in
+    # search image coordinates. With p_labels (the output of
+    # SampleColorClassifier.classify) the mask of the color is taken from
+    # the labels; without it only YELLOW is supported. Stage timing and
+    # debug images are skipped when the chain runs on a worker thread.
+    def _find_color_contour(self, p_search_image, p_labels, p_color, p_buffers, p_on_worker):
+        timer = None if p_on_worker else stage_timer
+        if timer is not None:
+            stage_start = timer.start()
+        search_height, search_width = p_search_image.shape[:2]
+        search_shape = (search_height, search_width)
+        if p_labels is not None:
+            thresholded = SampleColorClassifier.get_color_mask(p_labels, p_color,
+                                                               p_buffers.get("thresholded", search_shape))
+        else:
+            # Demonstrate how to find the yellow samples by thresholding
+            # the green channel of the original BGR image.
+            g = cv2.extractChannel(p_search_image, 1, dst=p_buffers.get("green_channel", search_shape))
+            thresholded = ImageUtils.apply_grayscale_threshold(g, SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW,
+                                                               p_buffers.get("thresholded", search_shape))
+        if timer is not None:
+            timer.stop(PipelineStage.THRESHOLD, stage_start)
+            stage_start = timer.start()
+
+        show_debug_images = PipelineOptions.SHOW_DEBUG_IMAGES and not p_on_worker
+        if show_debug_images:
+            cv2.imshow("ThrN" if p_color == SampleRecognition.SampleColor.YELLOW else "Thr" + p_color.name[0],
+                       thresholded)
+            cv2.waitKey(0)
+
+        # Sanitize the thresholded samples by eliminating contours
+        # that are below the minimum allowable area or above the maximum
+        # allowable area.
+        if PipelineOptions.CONTOUR_FILTER == PipelineOptions.ContourFilter.COMPONENTS:
+            filtered = ImageUtils.filter_components_limelight(thresholded,
+                                                              SampleParameters.MIN_SAMPLE_AREA / 2.0,
+                                                              SampleParameters.MAX_SAMPLE_AREA,
+                                                              SampleParameters.MIN_SAMPLE_ASPECT_RATIO,
+                                                              SampleParameters.MAX_SAMPLE_ASPECT_RATIO,
+                                                              p_buffers)
+        else:
+            filtered = ImageUtils.filter_contours_limelight(thresholded, search_height, search_width,
+                                                            SampleParameters.MIN_SAMPLE_AREA / 2.0,
+                                                            SampleParameters.MAX_SAMPLE_AREA, p_buffers,
+                                                            show_debug_images)
+
+        if timer is not None:
+            timer.stop(PipelineStage.CONTOUR_FILTER, stage_start)
+        return filtered
+
+    # Find the candidate samples in a copy of the image that has been
+    # downscaled by p_scale and return (x0, y0, x1, y1) search windows
+    # around them in full-resolution coordinates for perform_recognition.
+    # The areas of blobs of similar size may come out in a different
+    # order at low resolution so every candidate whose area is at least
+    # PYRAMID_CANDIDATE_AREA_RATIO of the largest one gets a window; with
+    # p_all_candidates every blob that passes the area filter does, for
+    # a caller that wants all of the candidates ranked. Returns an empty
+    # list if there are no candidates.
+    def find_candidate_windows(self, image, p_scale, p_all_candidates=False):
+        timer = stage_timer
+        if timer is not None:
+            stage_start = timer.start()
+        image_height, image_width = image.shape[:2]
+        small_width, small_height = image_width // p_scale, image_height // p_scale
+        small_image = cv2.resize(image, (small_width, small_height),
+                                 interpolation=PipelineOptions.PYRAMID_INTERPOLATION,
+                                 dst=self.buffers.get("pyramid_image", (small_height, small_width, 3)))
+        small_shape = (small_height, small_width)
+        g = cv2.extractChannel(small_image, 1, dst=self.buffers.get("pyramid_green_channel", small_shape))
+        thresholded = ImageUtils.apply_grayscale_threshold(g, SampleParameters.GREEN_CHANNEL_THRESHOLD_LOW,
+                                                           self.buffers.get("pyramid_thresholded", small_shape))
+        if timer is not None:
+            timer.stop(PipelineStage.THRESHOLD, stage_start)
+            stage_start = timer.start()
+
+        # The area of a blob in the downscaled image is only approximately
+        # its full-resolution area divided by p_scale squared, so widen
+        # the limits here. The exact limits are applied at full resolution.
+        area_scale = float(p_scale * p_scale)
+        filtered = ImageUtils.filter_contours_limelight(
+            thresholded, small_height, small_width,
+            (SampleParameters.MIN_SAMPLE_AREA / 2.0) / area_scale * (1.0 - PipelineOptions.PYRAMID_AREA_TOLERANCE),
+            SampleParameters.MAX_SAMPLE_AREA / area_scale * (1.0 + PipelineOptions.PYRAMID_AREA_TOLERANCE),
+            self.buffers, PipelineOptions.SHOW_DEBUG_IMAGES)
+        if timer is not None:
+            timer.stop(PipelineStage.CONTOUR_FILTER, stage_start)
+
+        if not filtered.filtered_contours:
+            return []
+
+        candidate_areas = [cv2.contourArea(contour) for contour in filtered.filtered_contours]
+        min_candidate_area = 0.0 if p_all_candidates else max(candidate_areas) * PipelineOptions.PYRAMID_CANDIDATE_AREA_RATIO
+
+        # Leave room on each side for the pixels that were lost or
+        # gained in the downscaling.
+        margin = 2 * p_scale
+        candidate_windows = []
+        for contour, area in zip(filtered.filtered_contours, candidate_areas):
+            if area < min_candidate_area:
+                continue
+
+            x, y, w, h = cv2.boundingRect(contour)
+            candidate_windows.append((max(0, x * p_scale - margin), max(0, y * p_scale - margin),
+                                      min(image_width, (x + w) * p_scale + margin),
+                                      min(image_height, (y + h) * p_scale + margin)))
+
+        return candidate_windows
+
+    # The edges of the search window that coincide with the edges of
+    # the image don't count.
+    @staticmethod
+    def _touches_search_window_edge(p_contour, p_search_width, p_search_height, p_search_window, p_image_shape):
+        x, y, w, h = cv2.boundingRect(p_contour)
+        window_x0, window_y0, window_x1, window_y1 = p_search_window
+        image_height, image_width = p_image_shape[:2]
+        return ((x == 0 and window_x0 > 0) or
+                (y == 0 and window_y0 > 0) or
+                (x + w >= p_search_width and window_x1 < image_width) or
+                (y + h >= p_search_height and window_y1 < image_height))
+
+# Whether cv2.boxPoints computes points 2 and 3 of a RotatedRect by
+# reflecting points 0 and 1 through the center (OpenCV 4) rather than
+# directly; see SampleRecognition.get_box_points. Found on first use
+# by comparing both with cv2.boxPoints on rectangles at angles from
+# -90 to 90 degrees (minAreaRect returns (0, 90] or [-90, 0) depending
+# on the version), including exactly -90, 0 and 90 and squares.
+_box_points_reflected = None
+
+def _box_points_by_reflection():
+    global _box_points_reflected
+    if _box_points_reflected is None:
+        rng = np.random.default_rng(5921)
+        probe_rects = np.column_stack([rng.uniform(0.0, 1280.0, (96, 2)), rng.uniform(1.0, 300.0, (96, 2)),
+                                       rng.uniform(-90.0, 90.0, 96)])
+        probe_rects[64:, 3] = probe_rects[64:, 2]  # squares
+        probe_rects[::8, 4] = -90.0
+        probe_rects[1::8, 4] = 0.0
+        probe_rects[2::8, 4] = 90.0
+        probe_rects = probe_rects.astype(np.float32)
+
+        radians = probe_rects[:, 4].astype(np.float64) * np.pi / 180.0
+        b = np.cos(radians).astype(np.float32) * np.float32(0.5)
+        a = np.sin(radians).astype(np.float32) * np.float32(0.5)
+        center_x = probe_rects[:, 0]
+        center_y = probe_rects[:, 1]
+        width = probe_rects[:, 2]
+        height = probe_rects[:, 3]
+        reflected = np.column_stack([np.float32(2) * center_x - (center_x - a * height - b * width),
+                                     np.float32(2) * center_y - (center_y + b * height - a * width),
+                                     np.float32(2) * center_x - (center_x + a * height - b * width),
+                                     np.float32(2) * center_y - (center_y - b * height - a * width)])
+        opencv = np.array([cv2.boxPoints(((float(rect[0]), float(rect[1])), (float(rect[2]), float(rect[3])),
+                                          float(rect[4])))[2:].ravel() for rect in probe_rects])
+        _box_points_reflected = bool(np.array_equal(reflected, opencv))
+    return _box_points_reflected
+
+# BGR values added to the filtered binary image of each color with
+# SampleRecognition.OutputMode.DEBUG.
+DEBUG_OVERLAY_TINTS = {SampleRecognition.SampleColor.BLUE: (96, 0, 0, 0),
+                       SampleRecognition.SampleColor.RED: (0, 0, 96, 0),
+                       SampleRecognition.SampleColor.YELLOW: (0, 96, 96, 0)}
+
+# The thread pool for PipelineOptions.MULTI_COLOR persists across
+# calls to runPipeline; it is replaced if COLOR_WORKERS changes.
+# Returns None for a single worker.
+_color_executor = None
+_color_executor_workers = 0
+
+def get_color_executor():
+    global _color_executor, _color_executor_workers
+    if PipelineOptions.COLOR_WORKERS <= 1:
+        return None
+
+    if _color_executor is None or _color_executor_workers != PipelineOptions.COLOR_WORKERS:
+        if _color_executor is not None:
+            _color_executor.shutdown(wait=True)
+        _color_executor = ThreadPoolExecutor(max_workers=PipelineOptions.COLOR_WORKERS,
+                                             thread_name_prefix="SampleColor")
+        _color_executor_workers = PipelineOptions.COLOR_WORKERS
+    return _color_executor
+
+#################################################################
+# SampleTracker.py
+#################################################################
+# While the robot is picking up a sample it asks for several frames
+# in a row and the sample barely moves between them. The tracker
+# remembers where the last sample was found so that the next frame
+# can be searched in a padded window around it first.
+#
+# The tracker goes back to a full-frame search after a miss, after
+# PipelineOptions.ROI_TIMEOUT_SECONDS without a hit, and whenever
+# the alliance changes. The counters give the ROI hit rate and the
+# fraction of the pixels that were actually searched.
+class SampleTracker:
+    def __init__(self):
+        self.alliance = None
+        self.last_hit_time = 0.0
+        self.last_rotated_rect = None
+
+        self.num_roi_searches = 0
+        self.num_roi_hits = 0
+        self.num_full_frame_searches = 0
+        self.num_pixels_searched = 0
+        self.num_frame_pixels = 0
+
+    def reset(self):
+        self.last_rotated_rect = None
+
+    # Returns the (x0, y0, x1, y1) window to search first or None for
+    # the full frame.
+    def get_search_window(self, p_alliance, p_image_shape):
+        if p_alliance != self.alliance:
+            self.alliance = p_alliance
+            self.reset()
+
+        if self.last_rotated_rect is None:
+            return None
+
+        if time.monotonic() - self.last_hit_time > PipelineOptions.ROI_TIMEOUT_SECONDS:
+            self.reset()
+            return None
+
+        image_height, image_width = p_image_shape[:2]
+        half_size = max(self.last_rotated_rect.width, self.last_rotated_rect.height) * (0.5 + PipelineOptions.ROI_PADDING)
+        x0 = max(0, int(self.last_rotated_rect.center_x - half_size))
+        y0 = max(0, int(self.last_rotated_rect.center_y - half_size))
+        x1 = min(image_width, int(np.ceil(self.last_rotated_rect.center_x + half_size)))
+        y1 = min(image_height, int(np.ceil(self.last_rotated_rect.center_y + half_size)))
+        if x1 <= x0 or y1 <= y0:
+            self.reset()
+            return None
+
+        return x0, y0, x1, y1
+
+    # Record the outcome of a search of p_search_window (None for the
+    # full frame).
+    def update(self, p_ret_val, p_search_window, p_image_shape):
+        image_height, image_width = p_image_shape[:2]
+        if p_search_window is None:
+            self.num_full_frame_searches += 1
+            self.num_pixels_searched += image_height * image_width
+        else:
+            self.num_roi_searches += 1
+            self.num_pixels_searched += (p_search_window[2] - p_search_window[0]) * (p_search_window[3] - p_search_window[1])
+
+        if p_ret_val.status == SampleRecognition.SampleRecognitionReturn.RecognitionStatus.SUCCESS:
+            if p_search_window is not None:
+                self.num_roi_hits += 1
+            self.last_rotated_rect = p_ret_val.rotated_rect
+            self.last_hit_time = time.monotonic()
+        else:
+            self.reset()
+
+    # Called once per frame for which recognition was performed.
+    def count_frame(self, p_image_shape):
+        self.num_frame_pixels += p_image_shape[0] * p_image_shape[1]
+
+    def get_roi_hit_rate(self):
+        return self.num_roi_hits / self.num_roi_searches if self.num_roi_searches else 0.0
+
+    # The fraction of the frame pixels that were thresholded and
+    # filtered, including full-frame searches after a miss.
+    def get_searched_pixel_fraction(self):
+        return self.num_pixels_searched / self.num_frame_pixels if self.num_frame_pixels else 0.0
+
+#################################################################
+# RecognitionEngine.py
+#################################################################
+# Everything that should survive from one call of runPipeline to the
+# next: the scratch buffers and one SampleRecognition per alliance.
+# The Limelight runs this script in a single long-lived process so
+# there is one engine at module level.
+#
+# Note that the image returned as the drawn target lives in a
+# reused buffer and is overwritten by the next frame.
+class RecognitionEngine:
+    def __init__(self):
+        self.buffers = FrameBuffers()
+        self.tracker = SampleTracker()
+        self.robot_stage_timer = None  # created the first time the robot asks for timing
+        self.stage_timing_request = 0
+        self._recognitions = {}
+
+    def get_sample_recognition(self, p_alliance):
+        recognition = self._recognitions.get(p_alliance)
+        if recognition is None:
+            recognition = SampleRecognition(p_alliance, self.buffers)
+            self._recognitions[p_alliance] = recognition
+        return recognition
+
+    # Recognition for one frame, first in the tracker's window around
+    # the previous sample (if ROI tracking is on) and then, if that
+    # fails, in the full frame (coarse-to-fine if the pyramid is on).
+    def perform_recognition(self, p_alliance, p_image, p_output_mode=SampleRecognition.OutputMode.ANNOTATED,
+                            p_num_candidates=0):
+        timer = stage_timer
+        if timer is None:
+            return self._perform_recognition(p_alliance, p_image, p_output_mode, p_num_candidates)
+
+        stage_start = timer.start()
+        ret_val = self._perform_recognition(p_alliance, p_image, p_output_mode, p_num_candidates)
+        timer.stop(PipelineStage.PERFORM_RECOGNITION, stage_start)
+        return ret_val
+
+    def _perform_recognition(self, p_alliance, p_image, p_output_mode, p_num_candidates):
+        recognition = self.get_sample_recognition(p_alliance)
+        if not PipelineOptions.ROI_TRACKING:
+            return self._search_full_frame(recognition, p_image, p_output_mode, p_num_candidates)
+
+        # The tracked window only holds the previous sample, so when the
+        # robot asks for candidates the full frame is searched to find
+        # every sample in view.
+        self.tracker.count_frame(p_image.shape)
+        search_window = self.tracker.get_search_window(p_alliance, p_image.shape)
+        if search_window is not None and p_num_candidates == 0:
+            ret_val = recognition.perform_recognition(p_image, [search_window], p_output_mode, p_num_candidates)
+            self.tracker.update(ret_val, search_window, p_image.shape)
+            if ret_val.status == SampleRecognition.SampleRecognitionReturn.RecognitionStatus.SUCCESS:
+                return ret_val
+
+        ret_val = self._search_full_frame(recognition, p_image, p_output_mode, p_num_candidates)
+        self.tracker.update(ret_val, None, p_image.shape)
+        return ret_val
+
+    # With the pyramid on, refine the downscaled candidate at full
+    # resolution; if there is no candidate or the refinement fails
+    # search the whole frame at full resolution.
+    @staticmethod
+    def _search_full_frame(p_recognition, p_image, p_output_mode, p_num_candidates):
+        if PipelineOptions.PYRAMID_SCALE > 1 and not PipelineOptions.MULTI_COLOR:
+            candidate_windows = p_recognition.find_candidate_windows(p_image, PipelineOptions.PYRAMID_SCALE,
+                                                                     p_num_candidates > 0)
+            if candidate_windows:
+                ret_val = p_recognition.perform_recognition(p_image, candidate_windows, p_output_mode,
+                                                            p_num_candidates)
+                if ret_val.status == SampleRecognition.SampleRecognitionReturn.RecognitionStatus.SUCCESS:
+                    ret_val.search_region = SampleRecognition.SearchRegion.PYRAMID
+                    return ret_val
+
+        return p_recognition.perform_recognition(p_image, None, p_output_mode, p_num_candidates)
+
+
+recognition_engine = RecognitionEngine()
+
+'''
+llRobot input mapping:
+llRobot[0] = alliance, one of SampleRecognition.Alliance.<alliance>.value, 0 for idle
+Optional - missing values are treated as 0:
+llRobot[1] = stage timing, one of LLRobot.StageTiming.<request>.value
+llRobot[2] = output image, one of SampleRecognition.OutputMode.<mode>.value
+llRobot[3] = maximum number of ranked candidates to return in LLPythonBlock.CANDIDATES, 0 for none
+'''
 
 '''
 llPython return value mapping:
@@ -373,14 +1685,520 @@ llPython[1] = sample color detected, one of SampleRecord.SampleColor.<color>.val
 llPython[2] = ftc_angle of selected sample
 llPython[3] = center of selected sample x (pixels)
 llPython[4] = center of selected sample y (pixels)
+
+If llRobot asks for optional data the values above are padded with 0
+to LLPYTHON_STATUS_SIZE and followed by one or more blocks of the form
+llPython[n] = block id, one of LLPythonBlock.<block>.value
+llPython[n + 1] = number of values in the block
+llPython[n + 2] ... the values
+
+LLPythonBlock.STAGE_TIMING: frame times of the frames in the timing
+buffer - number of frames, mean, median, 95th percentile, maximum (ms);
+recalculated on every frame for the first StageTimer.SUMMARY_INTERVAL
+frames and every StageTimer.SUMMARY_INTERVAL frames after that
+LLPythonBlock.FRAME_SEQUENCE (PipelineOptions.ASYNC_PIPELINE only):
+sequence number of the frame the result was computed from (0 if there
+is no result yet), sequence number of the current frame
+LLPythonBlock.CANDIDATES: number of candidates, then for each candidate,
+best first, CANDIDATE_STRIDE values - sample color, ftc_angle, center x,
+center y, score (0 to 1)
 '''
+class LLRobot:
+    ALLIANCE_INDEX = 0
+    STAGE_TIMING_INDEX = 1
+    OUTPUT_MODE_INDEX = 2
+    CANDIDATES_INDEX = 3
+
+    class StageTiming(Enum):
+        OFF = 0
+        ON = 1  # return LLPythonBlock.STAGE_TIMING
+        DUMP = 2  # as ON and also write the timing buffer to PipelineOptions.STAGE_TIMING_DUMP_FILE
+
+    @staticmethod
+    def get_value(p_llrobot, p_index):
+        return int(p_llrobot[p_index]) if len(p_llrobot) > p_index else 0
+
+    # Returns None when the robot doesn't want recognition (idle).
+    @staticmethod
+    def get_alliance(p_llrobot):
+        alliance_value = LLRobot.get_value(p_llrobot, LLRobot.ALLIANCE_INDEX)
+        for alliance in SampleRecognition.Alliance:
+            if alliance.value == alliance_value:
+                return alliance
+        return None
+
+    # Unknown values get the default, annotated, image.
+    @staticmethod
+    def get_output_mode(p_llrobot):
+        output_mode_value = LLRobot.get_value(p_llrobot, LLRobot.OUTPUT_MODE_INDEX)
+        for output_mode in SampleRecognition.OutputMode:
+            if output_mode.value == output_mode_value:
+                return output_mode
+        return SampleRecognition.OutputMode.ANNOTATED
+
+
+class LLPythonBlock(Enum):
+    STAGE_TIMING = 1
+    FRAME_SEQUENCE = 2
+    CANDIDATES = 3
+
+
+CANDIDATE_STRIDE = 5
+
+
+LLPYTHON_STATUS_SIZE = 5
+
+def append_llpython_block(p_llpython, p_block, p_values):
+    if len(p_llpython) < LLPYTHON_STATUS_SIZE:
+        p_llpython.extend([0] * (LLPYTHON_STATUS_SIZE - len(p_llpython)))
+    p_llpython.extend([p_block.value, len(p_values)])
+    p_llpython.extend(p_values)
+    return p_llpython
+
+
+# Installs or removes the robot's StageTimer to match the request in
+# llrobot and writes the timing buffer when the request changes to DUMP.
+def update_robot_stage_timing(p_stage_timing_request):
+    previous_request = recognition_engine.stage_timing_request
+    recognition_engine.stage_timing_request = p_stage_timing_request
+    if p_stage_timing_request == LLRobot.StageTiming.OFF.value:
+        if stage_timer is not None and stage_timer is recognition_engine.robot_stage_timer:
+            set_stage_timer(None)
+        return
+
+    if recognition_engine.robot_stage_timer is None:
+        recognition_engine.robot_stage_timer = StageTimer()
+    if stage_timer is None:
+        set_stage_timer(recognition_engine.robot_stage_timer)
+
+    if p_stage_timing_request == LLRobot.StageTiming.DUMP.value and previous_request != p_stage_timing_request:
+        recognition_engine.robot_stage_timer.dump(PipelineOptions.STAGE_TIMING_DUMP_FILE)
+
+#################################################################
+# ResultCache.py
+#################################################################
+# While the robot waits to pick up a sample it polls the Limelight
+# for up to a second and the scene hardly changes. The cache keeps the
+# result of the last recognition together with a thumbnail of its
+# frame - every (width / thumbnail width)'th pixel, so it costs a few
+# microseconds - and returns that result for a new frame with the same
+# llrobot inputs whose thumbnail has not changed.
+#
+# A thumbnail has changed if more than RESULT_CACHE_CHANGED_FRACTION
+# of its values differ from the cached thumbnail by more than
+# RESULT_CACHE_PIXEL_THRESHOLD, or if any value does in the cells
+# around the cached sample (its bounding rectangle widened by
+# RESULT_CACHE_TARGET_PADDING of its long side on every side): the
+# robot aligns on the center of the sample, so a small move of the
+# sample alone must not return its old position. A move of less than
+# one thumbnail cell (frame width / thumbnail width pixels, 10 at
+# 640x480) can still go unnoticed if no sampled pixel crosses an edge
+# of the sample, so that is the worst case center error. A cached
+# result older than RESULT_CACHE_MAX_AGE_SECONDS is never returned.
+class ResultCache:
+    def __init__(self):
+        self._buffers = FrameBuffers()
+        self._key = None  # (llrobot, image shape) of the cached result
+        self._time = 0.0
+        self._sample_contour = None
+        self._image = None  # None returns the current frame, as for OutputMode.MINIMAL
+        self._llpython = None
+        self._target_cells = None  # thumbnail rows and columns around the cached sample
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def clear(self):
+        self._key = None
+
+    # Returns the cached (sample_contour, image, llpython) if p_image
+    # and p_llrobot match the cached result, otherwise None. In either
+    # case the thumbnail of p_image is kept for store().
+    def lookup(self, p_image, p_llrobot):
+        thumbnail = self._buffers.get("thumbnail", self._get_thumbnail_shape(p_image))
+        cv2.resize(p_image, PipelineOptions.RESULT_CACHE_THUMBNAIL_SIZE, dst=thumbnail,
+                   interpolation=cv2.INTER_NEAREST)
+
+        if (self._key == (tuple(p_llrobot), p_image.shape) and
+                time.monotonic() - self._time <= PipelineOptions.RESULT_CACHE_MAX_AGE_SECONDS and
+                not self._has_changed(thumbnail)):
+            self.num_hits += 1
+            image = p_image if self._image is None else self._image
+            return self._sample_contour, image, list(self._llpython)
+
+        self.num_misses += 1
+        return None
+
+    # Caches the result for the frame last passed to lookup().
+    def store(self, p_image, p_llrobot, p_sample_contour, p_drawn_target, p_llpython):
+        thumbnail = self._buffers.get("thumbnail", self._get_thumbnail_shape(p_image))
+        cached_thumbnail = self._buffers.get("cached_thumbnail", thumbnail.shape)
+        np.copyto(cached_thumbnail, thumbnail)
+
+        if p_drawn_target is p_image:
+            self._image = None
+        else:
+            self._image = self._buffers.get("cached_image", p_drawn_target.shape)
+            np.copyto(self._image, p_drawn_target)
+
+        self._key = (tuple(p_llrobot), p_image.shape)
+        self._time = time.monotonic()
+        self._sample_contour = p_sample_contour
+        self._llpython = list(p_llpython)
+        self._target_cells = self._get_target_cells(p_sample_contour, p_image.shape, thumbnail.shape)
+
+    def get_hit_rate(self):
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups else 0.0
+
+    @staticmethod
+    def _get_thumbnail_shape(p_image):
+        thumbnail_width, thumbnail_height = PipelineOptions.RESULT_CACHE_THUMBNAIL_SIZE
+        return (thumbnail_height, thumbnail_width) + p_image.shape[2:]
+
+    # Returns the first and last + 1 thumbnail row and column around
+    # p_sample_contour, or None if there is no sample.
+    @staticmethod
+    def _get_target_cells(p_sample_contour, p_image_shape, p_thumbnail_shape):
+        if p_sample_contour is None or p_sample_contour.size == 0:
+            return None
+
+        x, y, width, height = cv2.boundingRect(p_sample_contour)
+        padding = max(width, height) * PipelineOptions.RESULT_CACHE_TARGET_PADDING
+        x_scale = p_thumbnail_shape[1] / p_image_shape[1]
+        y_scale = p_thumbnail_shape[0] / p_image_shape[0]
+        return (max(0, int((y - padding) * y_scale)),
+                min(p_thumbnail_shape[0], int(np.ceil((y + height + padding) * y_scale))),
+                max(0, int((x - padding) * x_scale)),
+                min(p_thumbnail_shape[1], int(np.ceil((x + width + padding) * x_scale))))
+
+    def _has_changed(self, p_thumbnail):
+        cached_thumbnail = self._buffers.get("cached_thumbnail", p_thumbnail.shape)
+        difference = cv2.absdiff(p_thumbnail, cached_thumbnail, dst=self._buffers.get("difference", p_thumbnail.shape))
+        # Compare every channel value, not just every pixel.
+        changed = cv2.compare(difference.reshape(p_thumbnail.shape[0], -1), PipelineOptions.RESULT_CACHE_PIXEL_THRESHOLD,
+                              cv2.CMP_GT)
+        if self._target_cells is not None:
+            row_0, row_1, column_0, column_1 = self._target_cells
+            num_channels = changed.shape[1] // p_thumbnail.shape[1]
+            if cv2.countNonZero(changed[row_0:row_1, column_0 * num_channels:column_1 * num_channels]) > 0:
+                return True
+        return cv2.countNonZero(changed) > PipelineOptions.RESULT_CACHE_CHANGED_FRACTION * difference.size
+
+
+result_cache = ResultCache()
+
+#################################################################
+# FrameRecorder.py
+#################################################################
+# Records the stream of frames that runPipeline sees so that a match
+# can be replayed exactly (see runPipeline_Replay.py). The file is a
+# header followed by fixed-size records, so a reader can memory-map
+# it as a NumPy structured array and pass each frame to runPipeline
+# as a view without copying or decoding it.
+#
+# Each record holds the time the frame arrived (time.monotonic_ns),
+# the llrobot input and the llpython output, each padded to a fixed
+# number of slots with the number of values actually used, and the
+# raw frame. All frames in a file must have the same shape; frames of
+# another shape are counted and skipped. An existing file with the
+# same layout is appended to. A record cut off by a crash is ignored
+# by the reader.
+class FrameRecorder:
+    MAGIC = b"LLFRAMES"
+    VERSION = 1
+    LLROBOT_SLOTS = 8
+    LLPYTHON_SLOTS = 256
+
+    HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("height", "<u4"), ("width", "<u4"),
+                             ("channels", "<u4"), ("llrobot_slots", "<u4"), ("llpython_slots", "<u4")])
+
+    def __init__(self):
+        self.path = None
+        self._file = None
+        self._record = None
+        self.num_records = 0
+        self.num_skipped_frames = 0
+
+    @staticmethod
+    def get_record_dtype(p_frame_shape, p_llrobot_slots=LLROBOT_SLOTS, p_llpython_slots=LLPYTHON_SLOTS):
+        return np.dtype([("timestamp_ns", "<i8"), ("llrobot_count", "<i4"), ("llpython_count", "<i4"),
+                         ("llrobot", "<f8", (p_llrobot_slots,)), ("llpython", "<f8", (p_llpython_slots,)),
+                         ("frame", "u1", p_frame_shape)])
+
+    def write(self, p_path, p_image, p_llrobot, p_llpython):
+        if p_path != self.path:
+            self.close()
+            self.path = p_path
+            self._open(p_image.shape)
+        if self._file is None:
+            return
+
+        record = self._record[0]
+        if p_image.shape != record["frame"].shape:
+            self.num_skipped_frames += 1
+            return
+        if len(p_llrobot) > self.LLROBOT_SLOTS or len(p_llpython) > self.LLPYTHON_SLOTS:
+            pipeline_log.warning("FrameRecorder: llrobot or llpython longer than its slots, truncated")
+
+        record["timestamp_ns"] = time.monotonic_ns()
+        record["llrobot_count"] = min(len(p_llrobot), self.LLROBOT_SLOTS)
+        record["llrobot"][:] = 0.0
+        record["llrobot"][:record["llrobot_count"]] = p_llrobot[:self.LLROBOT_SLOTS]
+        record["llpython_count"] = min(len(p_llpython), self.LLPYTHON_SLOTS)
+        record["llpython"][:] = 0.0
+        record["llpython"][:record["llpython_count"]] = p_llpython[:self.LLPYTHON_SLOTS]
+        record["frame"][...] = p_image
+        self._file.write(self._record.data)
+        self.num_records += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.path = None
+
+    def _open(self, p_frame_shape):
+        frame_shape = tuple(p_frame_shape) + (1,) * (3 - len(p_frame_shape))
+        header = np.zeros(1, dtype=self.HEADER_DTYPE)
+        header[0] = (self.MAGIC, self.VERSION, frame_shape[0], frame_shape[1], frame_shape[2],
+                     self.LLROBOT_SLOTS, self.LLPYTHON_SLOTS)
+        try:
+            self._file = open(self.path, "ab")
+            if self._file.tell() == 0:
+                self._file.write(header.tobytes())
+            elif self.read_header(self.path) != header.tobytes():
+                pipeline_log.error("FrameRecorder: %s has a different frame shape or layout", self.path)
+                self._file.close()
+                self._file = None
+                return
+        except OSError as e:
+            pipeline_log.error("FrameRecorder: %r", e)
+            self._file = None
+            return
+
+        self._record = np.zeros(1, dtype=self.get_record_dtype(tuple(p_frame_shape)))
+
+    @staticmethod
+    def read_header(p_path):
+        with open(p_path, "rb") as capture_file:
+            return capture_file.read(FrameRecorder.HEADER_DTYPE.itemsize)
+
+    # Memory-maps a capture file read-only and returns its records as a
+    # NumPy structured array; record["frame"] is a view of the file.
+    @staticmethod
+    def open_records(p_path):
+        header = np.frombuffer(FrameRecorder.read_header(p_path), dtype=FrameRecorder.HEADER_DTYPE)
+        if header.size == 0 or header[0]["magic"] != FrameRecorder.MAGIC or header[0]["version"] != FrameRecorder.VERSION:
+            raise ValueError(p_path + " is not a FrameRecorder capture file")
+
+        header = header[0]
+        frame_shape = (int(header["height"]), int(header["width"]), int(header["channels"]))
+        if frame_shape[2] == 1:
+            frame_shape = frame_shape[:2]
+        record_dtype = FrameRecorder.get_record_dtype(frame_shape, int(header["llrobot_slots"]),
+                                                      int(header["llpython_slots"]))
+        num_records = (os.path.getsize(p_path) - FrameRecorder.HEADER_DTYPE.itemsize) // record_dtype.itemsize
+        if num_records == 0:
+            return np.zeros(0, dtype=record_dtype)
+        return np.memmap(p_path, dtype=record_dtype, mode="r", offset=FrameRecorder.HEADER_DTYPE.itemsize,
+                         shape=(num_records,))
+
+
+frame_recorder = FrameRecorder()
+atexit.register(frame_recorder.close)
+
+#################################################################
+# AsyncPipeline.py
+#################################################################
+# With PipelineOptions.ASYNC_PIPELINE the Limelight's call to
+# runPipeline no longer waits for recognition. The frame is copied
+# and handed to a background thread (OpenCV releases the GIL while
+# it works) and runPipeline immediately returns the most recent
+# result that the thread has completed, tagged with the sequence
+# numbers of the frame it came from and of the current frame (see
+# LLPythonBlock.FRAME_SEQUENCE).
+#
+# There is at most one frame waiting for the thread; a newer frame
+# replaces it, so stale frames are dropped rather than queued. Two
+# frame buffers (the one being worked on and the one waiting) and
+# two result images (the one last returned to the Limelight and the
+# one the thread writes next) are enough.
+#
+# A result is only returned for the same llrobot inputs it was
+# computed with and only if its frame arrived no more than
+# PipelineOptions.ASYNC_MAX_RESULT_AGE_SECONDS ago, so a result from
+# before the robot switched pipelines is not mistaken for a new one.
+# An idle request or a black frame is answered at once, on the
+# calling thread, and no result from an earlier frame is returned
+# after it. Until there is a result the status is IMAGE_NOT_AVAILABLE.
+class AsyncPipeline:
+    class _Result:
+        def __init__(self, sample_contour, image_index, image, llpython, frame_sequence, frame_time, llrobot):
+            self.sample_contour = sample_contour
+            self.image_index = image_index
+            self.image = image
+            self.llpython = llpython
+            self.frame_sequence = frame_sequence
+            self.frame_time = frame_time  # time.monotonic() when the frame arrived
+            self.llrobot = llrobot
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._thread = None
+        self._buffers = FrameBuffers()
+        self._black_check_buffers = FrameBuffers()  # only used by the calling thread
+        self._working_frame_index = None
+        self._pending = None  # (frame buffer index, frame, llrobot, frame sequence, frame time)
+        self._latest_result = None
+        self._min_result_sequence = 0  # results of earlier frames are not returned
+        self._returned_image_index = None
+
+        self.num_frames = 0
+        self.num_dropped_frames = 0
+        self.num_completed_frames = 0
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._work, name="AsyncPipeline", daemon=True)
+        self._thread.start()
+
+    def run(self, image, llrobot):
+        llrobot_key = tuple(llrobot)
+        frame_time = time.monotonic()
+        if LLRobot.get_alliance(llrobot) is None:
+            return self._run_now(image, llrobot, _run_pipeline(image, llrobot))
+        if ImageUtils.is_black_image(image, PipelineOptions.BLACK_FRAME_ROW_STRIDE, self._black_check_buffers):
+            if pipeline_log.has_records():
+                pipeline_log.flush()
+            return self._run_now(image, llrobot, (np.array([[]]), image, [
+                SampleRecognition.SampleRecognitionReturn.RecognitionStatus.IMAGE_NOT_AVAILABLE.value]))
+
+        with self._condition:
+            if self._thread is None:
+                self._start()
+
+            self.num_frames += 1
+            frame_sequence = self.num_frames
+            if self._pending is not None:
+                frame_index = self._pending[0]
+                self.num_dropped_frames += 1
+            else:
+                frame_index = 1 if self._working_frame_index == 0 else 0
+
+            frame = self._buffers.get("frame_" + str(frame_index), image.shape)
+            np.copyto(frame, image)
+            self._pending = (frame_index, frame, llrobot_key, frame_sequence, frame_time)
+            self._condition.notify()
+
+            result = self._latest_result
+            if (result is not None and result.llrobot == llrobot_key and
+                    result.frame_sequence >= self._min_result_sequence and
+                    frame_time - result.frame_time <= PipelineOptions.ASYNC_MAX_RESULT_AGE_SECONDS):
+                self._returned_image_index = result.image_index
+            else:
+                result = None
+
+        if result is None:
+            llpython = [SampleRecognition.SampleRecognitionReturn.RecognitionStatus.IMAGE_NOT_AVAILABLE.value]
+            return np.array([[]]), image, append_llpython_block(llpython, LLPythonBlock.FRAME_SEQUENCE,
+                                                                [0, frame_sequence])
+
+        llpython = append_llpython_block(list(result.llpython), LLPythonBlock.FRAME_SEQUENCE,
+                                         [result.frame_sequence, frame_sequence])
+        return result.sample_contour, result.image, llpython
+
+    # Returns p_result, which was computed on the calling thread from the
+    # current frame, and discards the waiting frame and every result of
+    # an earlier frame.
+    def _run_now(self, image, llrobot, p_result):
+        with self._condition:
+            self.num_frames += 1
+            frame_sequence = self.num_frames
+            if self._pending is not None:
+                self._pending = None
+                self.num_dropped_frames += 1
+            self._min_result_sequence = frame_sequence + 1
+
+        sample_contour, drawn_target, llpython = p_result
+        return sample_contour, drawn_target, append_llpython_block(llpython, LLPythonBlock.FRAME_SEQUENCE,
+                                                                   [frame_sequence, frame_sequence])
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                frame_index, frame, llrobot_key, frame_sequence, frame_time = self._pending
+                self._pending = None
+                self._working_frame_index = frame_index
+
+            try:
+                sample_contour, drawn_target, llpython = _run_timed_pipeline(frame, list(llrobot_key))
+            except Exception as e:
+                pipeline_log.error("AsyncPipeline: %r", e)
+                with self._condition:
+                    self._working_frame_index = None
+                continue
+
+            with self._condition:
+                image_index = 1 if self._returned_image_index == 0 else 0
+                result_image = self._buffers.get("result_" + str(image_index), drawn_target.shape)
+                np.copyto(result_image, drawn_target)
+                self._latest_result = AsyncPipeline._Result(sample_contour, image_index, result_image, llpython,
+                                                            frame_sequence, frame_time, llrobot_key)
+                self._working_frame_index = None
+                self.num_completed_frames += 1
+
+
+async_pipeline = AsyncPipeline()
 
 #################################################################
 # Main program
 #################################################################
 def runPipeline(image, llrobot):
-    print(platform.system())
-
+    if PipelineOptions.ASYNC_PIPELINE:
+        result = async_pipeline.run(image, llrobot)
+    else:
+        result = _run_timed_pipeline(image, llrobot)
+
+    if PipelineOptions.CAPTURE_FILE is not None:
+        # The timer belongs to the pipeline thread, which is not this
+        # one in asynchronous mode.
+        timer = None if PipelineOptions.ASYNC_PIPELINE else stage_timer
+        if timer is not None:
+            stage_start = timer.start()
+        frame_recorder.write(PipelineOptions.CAPTURE_FILE, image, llrobot, result[2])
+        if timer is not None:
+            timer.stop(PipelineStage.CAPTURE, stage_start)
+    return result
+
+
+# Runs on the pipeline thread: the caller's in synchronous mode, the
+# AsyncPipeline worker's otherwise. The robot's timing request is
+# applied here so that only this thread changes or writes to the
+# stage timer.
+def _run_timed_pipeline(image, llrobot):
+    stage_timing_request = LLRobot.get_value(llrobot, LLRobot.STAGE_TIMING_INDEX)
+    if stage_timing_request != recognition_engine.stage_timing_request:
+        update_robot_stage_timing(stage_timing_request)
+
+    timer = stage_timer
+    if timer is None:
+        return _run_pipeline(image, llrobot)
+
+    frame_start = timer.start()
+    sample_contour, drawn_target, llpython = _run_pipeline(image, llrobot)
+
+    # The summary is of the frames before this one; it is inside the
+    # frame time so that its cost is measured too.
+    if LLRobot.get_value(llrobot, LLRobot.STAGE_TIMING_INDEX) != LLRobot.StageTiming.OFF.value:
+        append_llpython_block(llpython, LLPythonBlock.STAGE_TIMING, timer.get_frame_time_summary())
+    timer.stop(PipelineStage.FRAME, frame_start)
+    timer.end_frame(frame_start)
+    return sample_contour, drawn_target, llpython
+
+
+def _run_pipeline(image, llrobot):
     alliance_ordinal = int(llrobot[0])
 
     match alliance_ordinal:
@@ -389,25 +2207,47 @@ def runPipeline(image, llrobot):
         case 2:
             alliance = SampleRecognition.Alliance.RED
         case _:
+            # Nothing to recognize: a good time to write out the log.
+            if pipeline_log.has_records():
+                pipeline_log.flush()
             return np.array([[]]), image, [
                 SampleRecognition.SampleRecognitionReturn.RecognitionStatus.IDLE.value,
                 SampleRecognition.SampleColor.NONE.value]
 
     try:
+        timer = stage_timer
+
         ##!! It can happen that the Limelight runtime calls
         # runPipeline before an image is actually available,
         # probably because of the settable exposure time. So
         # we'll test for an all-black image and return a code
         # to the caller.
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        non_zero_pixel_count = cv2.countNonZero(gray_image)
-        if non_zero_pixel_count == 0:
+        if timer is not None:
+            stage_start = timer.start()
+        black_image = ImageUtils.is_black_image(image, PipelineOptions.BLACK_FRAME_ROW_STRIDE,
+                                                recognition_engine.buffers)
+        if timer is not None:
+            timer.stop(PipelineStage.BLACK_FRAME_CHECK, stage_start)
+        if black_image:
+            # No recognition on this frame either.
+            if pipeline_log.has_records():
+                pipeline_log.flush()
             return np.array([[]]), image, [
                 SampleRecognition.SampleRecognitionReturn.RecognitionStatus.IMAGE_NOT_AVAILABLE.value]
 
-        recognition = SampleRecognition(alliance)
-        ret_val = recognition.perform_recognition(image)
-        print(ret_val.status)
+        if PipelineOptions.RESULT_CACHE:
+            if timer is not None:
+                stage_start = timer.start()
+            cached_result = result_cache.lookup(image, llrobot)
+            if timer is not None:
+                timer.stop(PipelineStage.RESULT_CACHE, stage_start)
+            if cached_result is not None:
+                return cached_result
+
+        num_candidates = max(LLRobot.get_value(llrobot, LLRobot.CANDIDATES_INDEX), 0)
+        ret_val = recognition_engine.perform_recognition(alliance, image, LLRobot.get_output_mode(llrobot),
+                                                         num_candidates)
+        pipeline_log.debug("Recognition status %s", ret_val.status)
 
         if ret_val.status == SampleRecognition.SampleRecognitionReturn.RecognitionStatus.FAILURE:
             llpython = [SampleRecognition.SampleRecognitionReturn.RecognitionStatus.FAILURE.value,
@@ -422,20 +2262,30 @@ def runPipeline(image, llrobot):
                         ret_val.selected_sample_center_x,
                         ret_val.selected_sample_center_y]
 
+        if ret_val.candidates is not None:
+            candidate_values = [len(ret_val.candidates)]
+            for candidate in ret_val.candidates:
+                candidate_values.extend([candidate.color_value, candidate.ftc_angle,
+                                         candidate.center_x, candidate.center_y, candidate.score])
+            append_llpython_block(llpython, LLPythonBlock.CANDIDATES, candidate_values)
+
+        if PipelineOptions.RESULT_CACHE:
+            result_cache.store(image, llrobot, ret_val.sample_contour, ret_val.drawn_target, llpython)
+
         # Return the OpenCV contour of the selected sample for the LL crosshair,
         # the modified image, and custom robot data.
         return ret_val.sample_contour, ret_val.drawn_target, llpython
     except Exception as e:
-        # For debugging print out information from the exception.
-        print(repr(e))
-
-        # For an FTC client send the line number - also prints locally.
+        # For an FTC client send the line number - also logs locally.
         # Get the traceback information
         exc_type, exc_value, exc_traceback = sys.exc_info()
 
         # Extract the line number from the traceback
         line_number = traceback.extract_tb(exc_traceback)[-1][1]
 
+        # For debugging log information from the exception.
+        pipeline_log.error("%r at line %d", e, line_number)
+
         # Indicate that our application has crashed.
         return np.array([[]]), image, [
             SampleRecognition.SampleRecognitionReturn.RecognitionStatus.PYTHON_APP_CRASH.value,
@@ -0,0 +1,184 @@
+from detect_sample_as_runPipeline import LLPYTHON_STATUS_SIZE
+from detect_sample_as_runPipeline import LLRobot
+from detect_sample_as_runPipeline import PipelineOptions
+from detect_sample_as_runPipeline import SampleParameters
+from detect_sample_as_runPipeline import SampleRecognition
+from detect_sample_as_runPipeline import runPipeline
+import argparse
+import csv
+import cv2
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+
+# Runs runPipeline over every image in a directory tree, e.g. the
+# LRS_/LRF_/LRC_ snapshots pulled off the camera after an event, on a
+# pool of worker processes. Each worker reads its own images so the
+# images are never all in memory at once. One row per image is
+# written to a JSONL or CSV file (chosen by the extension of --output)
+# as soon as it is done: the image path, the status and llpython
+# output, and the time to read the image and to run the pipeline.
+#
+# With --resume the images already in the output file are skipped and
+# new rows are appended, so an interrupted run can be continued. A row
+# cut off when the run was stopped is dropped first and that image is
+# run again.
+# --param overrides a SampleParameters value for the whole run, for
+# re-scoring an archive with new thresholds.
+#
+# Examples (from the project root):
+#   python source-files/runPipeline_BatchEvaluator.py --image_dir snapshots --output results.jsonl
+#   python source-files/runPipeline_BatchEvaluator.py --image_dir snapshots --output results.csv --resume
+#   python source-files/runPipeline_BatchEvaluator.py --image_dir snapshots --output green150.jsonl \
+#       --param GREEN_CHANNEL_THRESHOLD_LOW=150
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+CSV_FIELDS = ["image", "status", "color", "ftc_angle", "x", "y", "llpython", "read_ms", "pipeline_ms", "error"]
+
+
+def find_images(image_dir, prefixes):
+    for dir_path, dir_names, filenames in os.walk(image_dir):
+        dir_names.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS) and (not prefixes or filename.startswith(tuple(prefixes))):
+                yield os.path.join(dir_path, filename)
+
+
+def parse_params(params):
+    overrides = {}
+    for param in params:
+        name, _, value = param.partition("=")
+        if not hasattr(SampleParameters, name):
+            raise ValueError("Unknown SampleParameters value " + name)
+        overrides[name] = type(getattr(SampleParameters, name))(value)
+    return overrides
+
+
+# Runs in each worker process before its first image.
+def init_worker(param_overrides):
+    for name, value in param_overrides.items():
+        setattr(SampleParameters, name, value)
+    PipelineOptions.SHOW_DEBUG_IMAGES = False
+
+
+def evaluate_image(task):
+    image_path, llrobot = task
+    row = {"image": image_path}
+    start = time.perf_counter()
+    image = cv2.imread(image_path)
+    row["read_ms"] = (time.perf_counter() - start) * 1000.0
+    if image is None:
+        row["error"] = "could not read image"
+        return row
+
+    start = time.perf_counter()
+    _, _, llpython = runPipeline(image, llrobot)
+    row["pipeline_ms"] = (time.perf_counter() - start) * 1000.0
+    row["llpython"] = [float(value) if isinstance(value, float) else int(value) for value in llpython]
+    row["status"] = row["llpython"][0]
+    return row
+
+
+# Drops a row cut off when the previous run was stopped, so the next row
+# isn't appended onto the end of it. Returns the size left in the file.
+def truncate_partial_row(output_path):
+    with open(output_path, "rb+") as output_file:
+        end = output_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            block_start = max(0, position - 4096)
+            output_file.seek(block_start)
+            block = output_file.read(position - block_start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                position = block_start + newline + 1
+                break
+            position = block_start
+        if position < end:
+            output_file.truncate(position)
+        return position
+
+
+def read_completed_images(output_path, is_csv):
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, newline="") as output_file:
+        if is_csv:
+            return {row["image"] for row in csv.DictReader(output_file)}
+
+        return {json.loads(line)["image"] for line in output_file if line.strip()}
+
+
+def to_csv_row(row):
+    llpython = row.get("llpython", [])
+    # color, ftc_angle, x, y; missing for IDLE, crashes etc.
+    status_values = (llpython[1:LLPYTHON_STATUS_SIZE] + [""] * LLPYTHON_STATUS_SIZE)[:LLPYTHON_STATUS_SIZE - 1]
+    return {"image": row["image"], "status": row.get("status", ""),
+            "color": status_values[0], "ftc_angle": status_values[1], "x": status_values[2], "y": status_values[3],
+            "llpython": json.dumps(llpython) if llpython else "",
+            "read_ms": f"{row['read_ms']:.3f}", "pipeline_ms": f"{row['pipeline_ms']:.3f}" if "pipeline_ms" in row else "",
+            "error": row.get("error", "")}
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image_dir", type=str, required=True, help="root of the directory tree of images")
+    ap.add_argument("--output", type=str, required=True, help="results file, .jsonl or .csv")
+    ap.add_argument("--alliance", type=str, default="RED")
+    ap.add_argument("--prefix", type=str, nargs="*", default=[],
+                    help="only images whose names start with one of these, e.g. LRS_ LRF_ LRC_")
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--chunksize", type=int, default=4, help="images handed to a worker at a time")
+    ap.add_argument("--resume", action="store_true", help="skip the images already in --output and append")
+    ap.add_argument("--param", type=str, action="append", default=[],
+                    help="override a SampleParameters value, NAME=VALUE (repeatable)")
+    args = vars(ap.parse_args())
+
+    param_overrides = parse_params(args["param"])
+    is_csv = args["output"].lower().endswith(".csv")
+    append = args["resume"] and os.path.exists(args["output"]) and truncate_partial_row(args["output"]) > 0
+    completed = read_completed_images(args["output"], is_csv) if append else set()
+    if completed:
+        print(f"Resuming: {len(completed)} images already in {args['output']}")
+
+    # The pipeline's output image is not kept so don't draw it.
+    llrobot = [SampleRecognition.Alliance[args["alliance"]].value, LLRobot.StageTiming.OFF.value,
+               SampleRecognition.OutputMode.MINIMAL.value]
+    tasks = ((image_path, llrobot) for image_path in find_images(args["image_dir"], args["prefix"])
+             if image_path not in completed)
+
+    statuses = Counter()
+    num_images = 0
+    start = time.perf_counter()
+    with open(args["output"], "a" if append else "w", newline="") as output_file, \
+            multiprocessing.Pool(args["workers"], initializer=init_worker, initargs=(param_overrides,)) as pool:
+        csv_writer = None
+        if is_csv:
+            csv_writer = csv.DictWriter(output_file, fieldnames=CSV_FIELDS)
+            if not append:
+                csv_writer.writeheader()
+
+        for row in pool.imap_unordered(evaluate_image, tasks, chunksize=args["chunksize"]):
+            if csv_writer is not None:
+                csv_writer.writerow(to_csv_row(row))
+            else:
+                output_file.write(json.dumps(row) + "\n")
+            output_file.flush()
+            num_images += 1
+            statuses[row.get("status", "error")] += 1
+
+    elapsed = time.perf_counter() - start
+    print(f"{num_images} images in {elapsed:.2f} s ({num_images / elapsed if elapsed > 0 else 0.0:.1f} images/s) "
+          f"with {args['workers']} workers")
+    for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+        print(f"  status {status}: {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
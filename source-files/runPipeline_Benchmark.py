@@ -0,0 +1,173 @@
+import detect_sample_as_runPipeline
+from detect_sample_as_runPipeline import LLRobot
+from detect_sample_as_runPipeline import PipelineOptions
+from detect_sample_as_runPipeline import PipelineStage
+from detect_sample_as_runPipeline import SampleRecognition
+from detect_sample_as_runPipeline import StageTimer
+from detect_sample_as_runPipeline import runPipeline
+import argparse
+import contextlib
+import cv2
+import json
+import numpy as np
+import os
+import sys
+
+# Headless benchmark that replays recorded images through runPipeline
+# and reports the latency percentiles of each stage of the pipeline.
+#
+# The images are every .png/.jpg in files/images plus any directories
+# given with --image_dir, e.g. the LRS_/LRF_ snapshots downloaded from
+# the Limelight. The results can be saved as a JSON baseline and later
+# runs compared against it; the program exits with status 1 if any
+# stage is slower than the baseline by more than the tolerance.
+#
+# Examples (from the project root):
+#   python source-files/runPipeline_Benchmark.py --save_baseline bench_baseline.json
+#   python source-files/runPipeline_Benchmark.py --image_dir snapshots --baseline bench_baseline.json
+#   python source-files/runPipeline_Benchmark.py --multi_color --color_workers 1
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+PERCENTILES = {"p50": 50, "p95": 95, "p99": 99}
+
+
+def find_images(image_dirs):
+    image_paths = []
+    for image_dir in image_dirs:
+        for dir_path, _, filenames in os.walk(image_dir):
+            image_paths.extend(os.path.join(dir_path, filename) for filename in filenames
+                               if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(image_paths)
+
+
+def summarize(frame_ms):
+    summary = {}
+    for stage in PipelineStage:
+        stage_ms = frame_ms[:, stage.value]
+        summary[stage.name] = {name: float(np.percentile(stage_ms, percentile))
+                               for name, percentile in PERCENTILES.items()}
+        summary[stage.name]["max"] = float(np.max(stage_ms))
+    return summary
+
+
+# Returns a list of messages, one for each stage and percentile that
+# is slower than the baseline by more than the tolerance.
+def find_regressions(summary, baseline, tolerance, min_regression_ms, compared):
+    regressions = []
+    for stage_name, stage_summary in summary.items():
+        baseline_stage = baseline.get("stages", {}).get(stage_name)
+        if baseline_stage is None:
+            continue
+
+        for name in compared:
+            limit = max(baseline_stage[name] * (1.0 + tolerance), baseline_stage[name] + min_regression_ms)
+            if stage_summary[name] > limit:
+                regressions.append(f"{stage_name} {name} {stage_summary[name]:.3f} ms > "
+                                   f"limit {limit:.3f} ms (baseline {baseline_stage[name]:.3f} ms)")
+    return regressions
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image_dir", type=str, action="append", default=[],
+                    help="additional directory of images to replay (repeatable)")
+    ap.add_argument("--skip_sample_images", action="store_true", help="don't replay files/images")
+    ap.add_argument("--alliance", type=str, default="RED")
+    ap.add_argument("--iterations", type=int, default=100, help="number of times each image is replayed")
+    ap.add_argument("--warmup", type=int, default=5, help="untimed iterations per image")
+    ap.add_argument("--pyramid_scale", type=int, default=1)
+    ap.add_argument("--roi_tracking", action="store_true")
+    ap.add_argument("--result_cache", action="store_true",
+                    help="reuse results for unchanged frames; the replayed frames repeat so most are hits")
+    ap.add_argument("--output_mode", type=str, default="ANNOTATED", help="ANNOTATED, MINIMAL or DEBUG")
+    ap.add_argument("--multi_color", action="store_true", help="look for alliance and yellow samples")
+    ap.add_argument("--color_workers", type=int, default=PipelineOptions.COLOR_WORKERS,
+                    help="threads for the per-color chains with --multi_color")
+    ap.add_argument("--save_baseline", type=str, help="write the results to this JSON file")
+    ap.add_argument("--baseline", type=str, help="compare the results with this JSON file")
+    ap.add_argument("--tolerance", type=float, default=0.25,
+                    help="allowed fractional slowdown of a stage compared with the baseline")
+    ap.add_argument("--min_regression_ms", type=float, default=0.05,
+                    help="ignore slowdowns smaller than this, which are usually noise")
+    ap.add_argument("--compare", type=str, nargs="+", default=["p50", "p95"],
+                    help="which of p50 p95 p99 max to compare with the baseline")
+    args = vars(ap.parse_args())
+
+    image_dirs = list(args["image_dir"])
+    if not args["skip_sample_images"]:
+        image_dirs.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "files", "images"))
+
+    images = []
+    for image_path in find_images(image_dirs):
+        image = cv2.imread(image_path)
+        if image is None:
+            print('Could not read ' + image_path)
+            continue
+        images.append((image_path, image))
+
+    if not images:
+        print('No images found')
+        return 1
+
+    PipelineOptions.SHOW_DEBUG_IMAGES = False
+    PipelineOptions.PYRAMID_SCALE = args["pyramid_scale"]
+    PipelineOptions.ROI_TRACKING = args["roi_tracking"]
+    PipelineOptions.MULTI_COLOR = args["multi_color"]
+    PipelineOptions.RESULT_CACHE = args["result_cache"]
+    PipelineOptions.COLOR_WORKERS = args["color_workers"]
+    llrobot = [SampleRecognition.Alliance[args["alliance"]].value, LLRobot.StageTiming.OFF.value,
+               SampleRecognition.OutputMode[args["output_mode"]].value]
+
+    timer = StageTimer(len(images) * args["iterations"])
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _, image in images:
+            for _ in range(args["warmup"]):
+                runPipeline(image, llrobot)
+
+            detect_sample_as_runPipeline.set_stage_timer(timer)
+            for _ in range(args["iterations"]):
+                runPipeline(image, llrobot)
+            detect_sample_as_runPipeline.set_stage_timer(None)
+
+    summary = summarize(timer.get_frame_ms())
+    print(f"{len(images)} images x {args['iterations']} iterations, times in ms")
+    if args["result_cache"]:
+        cache = detect_sample_as_runPipeline.result_cache
+        print(f"result cache: {cache.num_hits} hits, {cache.num_misses} misses")
+    print(f"{'stage':<20}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage_name, stage_summary in summary.items():
+        print(f"{stage_name:<20}" + "".join(f"{stage_summary[name]:>10.3f}" for name in ("p50", "p95", "p99", "max")))
+
+    results = {"images": [image_path for image_path, _ in images],
+               "iterations": args["iterations"],
+               "alliance": args["alliance"],
+               "pyramid_scale": args["pyramid_scale"],
+               "roi_tracking": args["roi_tracking"],
+               "output_mode": args["output_mode"],
+               "result_cache": args["result_cache"],
+               "multi_color": args["multi_color"],
+               "color_workers": args["color_workers"],
+               "stages": summary}
+    if args["save_baseline"]:
+        with open(args["save_baseline"], "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Saved baseline ' + args["save_baseline"])
+
+    if args["baseline"]:
+        with open(args["baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(summary, baseline, args["tolerance"], args["min_regression_ms"],
+                                       args["compare"])
+        if regressions:
+            print("Performance regression against " + args["baseline"])
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("No regressions against " + args["baseline"])
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
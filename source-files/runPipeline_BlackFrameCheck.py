@@ -0,0 +1,86 @@
+from detect_sample_as_runPipeline import ImageUtils
+from detect_sample_as_runPipeline import PipelineOptions
+import argparse
+import cv2
+import glob
+import numpy as np
+import os
+import sys
+
+# Checks that the sampled black frame check, ImageUtils.is_black_image
+# with PipelineOptions.BLACK_FRAME_ROW_STRIDE, classifies frames the
+# same way as converting the whole frame to gray and counting the
+# non-zero pixels. The frames are the sample images plus synthetic
+# all-black and near-black frames, including near-black frames with a
+# single lit pixel on a row that is not sampled.
+#
+# Example (from the project root):
+#   python source-files/runPipeline_BlackFrameCheck.py --image_dir=files/images
+
+
+def is_black_reference(image):
+    return cv2.countNonZero(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)) == 0
+
+
+# Near-black BGR values that convert to gray 0 and the darkest values
+# that convert to gray 1, found by converting every dark color.
+def find_dark_colors():
+    dark = np.array([[[b, g, r] for b in range(8) for g in range(8) for r in range(8)]], dtype=np.uint8)
+    gray = cv2.cvtColor(dark, cv2.COLOR_BGR2GRAY)[0]
+    return dark[0][gray == 0], dark[0][gray == 1]
+
+
+def synthetic_frames(height, width, row_stride, rng):
+    gray_0_colors, gray_1_colors = find_dark_colors()
+    yield "all black", np.zeros((height, width, 3), dtype=np.uint8)
+
+    near_black = gray_0_colors[rng.integers(0, len(gray_0_colors), size=(height, width))]
+    yield "near black", near_black
+
+    # Rows that the sampled check skips and rows that it converts.
+    for row in (1, row_stride - 1, 0, height - 1, (height // 2) - ((height // 2) % row_stride)):
+        for lit_color in (gray_1_colors[0], gray_1_colors[-1], np.array([255, 255, 255], dtype=np.uint8)):
+            frame = near_black.copy()
+            col = int(rng.integers(0, width))
+            frame[row, col] = lit_color
+            yield f"near black, pixel {tuple(int(c) for c in lit_color)} at ({col}, {row})", frame
+
+    # Every channel at the largest value that is still black in gray.
+    for color in gray_0_colors:
+        yield f"uniform {tuple(int(c) for c in color)}", np.full((height, width, 3), color, dtype=np.uint8)
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image_dir", type=str, default=os.path.join("files", "images"))
+    ap.add_argument("--row_stride", type=int, default=PipelineOptions.BLACK_FRAME_ROW_STRIDE)
+    ap.add_argument("--seed", type=int, default=5921)
+    args = vars(ap.parse_args())
+
+    frames = []
+    for image_path in sorted(glob.glob(os.path.join(args["image_dir"], "*.png"))):
+        image = cv2.imread(image_path)
+        if image is None:
+            print('Could not read ' + image_path)
+            continue
+        frames.append((os.path.basename(image_path), image))
+        frames.append((os.path.basename(image_path) + " (dimmed)", image // 64))
+
+    rng = np.random.default_rng(args["seed"])
+    frames.extend(synthetic_frames(480, 640, args["row_stride"], rng))
+
+    num_mismatches = 0
+    for name, frame in frames:
+        expected = is_black_reference(frame)
+        actual = ImageUtils.is_black_image(frame, args["row_stride"])
+        if actual != expected:
+            num_mismatches += 1
+            print(f"MISMATCH {name}: sampled check {actual}, full check {expected}")
+
+    print(f"{len(frames)} frames, {num_mismatches} mismatches")
+    return 1 if num_mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
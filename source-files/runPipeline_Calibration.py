@@ -0,0 +1,308 @@
+from detect_sample_as_runPipeline import ImageUtils
+from detect_sample_as_runPipeline import SampleParameters
+from detect_sample_as_runPipeline import SampleRecognition
+import argparse
+import csv
+import cv2
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+# Calibrates the thresholds and area limits in SampleParameters for one
+# sample color from labeled snapshots, instead of tuning them by hand
+# in IJThresholdTester or Gimp.
+#
+# The labels are a CSV file with the columns image,color,x,y: the
+# center of each sample of interest in an image (image is relative to
+# --image_dir, color is YELLOW, RED or BLUE). --write_labels writes
+# such a file from what the current SampleParameters find, to be
+# checked and corrected by hand.
+#
+# The HSV conversion and green channel of every image are computed once
+# and cached as .npy files in --cache_dir (by default under the system
+# temporary directory), which the worker processes memory-map. For RED
+# and BLUE the hue range to search around comes from
+# ImageUtils.get_hue_range on the hue histogram of the labeled samples.
+# Every combination in the grid of thresholds and minimum and
+# maximum areas is then run over all of the images on a pool of worker
+# processes. A setting is scored by the fraction of images in which the
+# largest filtered contour is within --tolerance pixels of a labeled
+# sample (or, in an image without a labeled sample of the color, in
+# which nothing is found) and then by its time per frame, the fastest
+# of TIMING_REPEATS runs on each image. The best setting - the most
+# accurate one closest to the current SampleParameters, so the same on
+# every run - is printed as a SampleParameters block ready to paste into
+# detect_sample_as_runPipeline.py.
+#
+# Examples (from the project root):
+#   python source-files/runPipeline_Calibration.py --image_dir files/images --write_labels labels.csv --color YELLOW
+#   python source-files/runPipeline_Calibration.py --image_dir files/images --labels labels.csv --color YELLOW
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+LABEL_FIELDS = ["image", "color", "x", "y"]
+TIMING_REPEATS = 3  # runs of each setting on each image, the fastest is its time
+
+# The cached images of the current worker process; see init_worker.
+_worker_images = []
+
+
+def find_images(image_dir):
+    image_names = []
+    for dir_path, _, filenames in os.walk(image_dir):
+        image_names.extend(os.path.relpath(os.path.join(dir_path, filename), image_dir) for filename in filenames
+                           if filename.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(image_names)
+
+
+def read_labels(labels_path):
+    labels = {}
+    with open(labels_path, newline="") as labels_file:
+        for row in csv.DictReader(labels_file):
+            labels.setdefault(row["image"], []).append((SampleRecognition.SampleColor[row["color"]],
+                                                        float(row["x"]), float(row["y"])))
+    return labels
+
+
+# The cache file names change with the image's path, size and time so
+# a changed image is converted again.
+def get_cache_prefix(cache_dir, image_path):
+    image_stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{image_stat.st_size}|{image_stat.st_mtime_ns}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def cache_image(task):
+    image_path, cache_prefix = task
+    if os.path.exists(cache_prefix + "_green.npy"):
+        return True
+
+    image = cv2.imread(image_path)
+    if image is None:
+        return False
+    np.save(cache_prefix + "_hsv.npy", cv2.cvtColor(image, cv2.COLOR_BGR2HSV))
+    # Written last: its presence marks a complete entry.
+    np.save(cache_prefix + "_green.npy", cv2.extractChannel(image, 1))
+    return True
+
+
+def load_cached_image(cache_prefix):
+    return (np.load(cache_prefix + "_hsv.npy", mmap_mode="r"),
+            np.load(cache_prefix + "_green.npy", mmap_mode="r"))
+
+
+def init_worker(images):
+    global _worker_images
+    _worker_images = [(load_cached_image(cache_prefix), sample_centers) for cache_prefix, sample_centers in images]
+
+
+# The part of the pipeline that a setting affects: threshold, then
+# filter the contours. Returns the largest contour or an empty array.
+def find_largest_contour(hsv_image, green_channel, setting):
+    if setting["color"] == SampleRecognition.SampleColor.YELLOW:
+        thresholded = ImageUtils.apply_grayscale_threshold(np.ascontiguousarray(green_channel),
+                                                           setting["GREEN_CHANNEL_THRESHOLD_LOW"])
+    else:
+        prefix = setting["color"].name + "_HSV_"
+        thresholded = ImageUtils.apply_inRange(hsv_image, setting[prefix + "HUE_LOW"], setting[prefix + "HUE_HIGH"],
+                                               setting[prefix + "SAT_THRESHOLD_LOW"],
+                                               setting[prefix + "VAL_THRESHOLD_LOW"])
+
+    # As in the pipeline, half of the minimum area.
+    image_height, image_width = thresholded.shape[:2]
+    filtered = ImageUtils.filter_contours_limelight(thresholded, image_height, image_width,
+                                                    setting["MIN_SAMPLE_AREA"] / 2.0, setting["MAX_SAMPLE_AREA"])
+    return filtered.largest_filtered_contour
+
+
+def evaluate_setting(task):
+    setting, tolerance = task
+    num_correct = 0
+    elapsed = 0.0
+    for (hsv_image, green_channel), sample_centers in _worker_images:
+        # The fastest of a few runs is much steadier than one run.
+        image_elapsed = []
+        for _ in range(TIMING_REPEATS):
+            start = time.perf_counter()
+            contour = find_largest_contour(hsv_image, green_channel, setting)
+            image_elapsed.append(time.perf_counter() - start)
+        elapsed += min(image_elapsed)
+
+        if contour.size == 0:
+            num_correct += not sample_centers
+            continue
+
+        (center_x, center_y), _, _ = cv2.minAreaRect(contour)
+        num_correct += any(np.hypot(center_x - x, center_y - y) <= tolerance for x, y in sample_centers)
+
+    num_images = len(_worker_images)
+    return setting, num_correct / num_images, elapsed / num_images * 1000.0
+
+
+# The hue histogram of the pixels around every labeled sample whose
+# saturation and value are at least the lowest in the grid.
+def get_labeled_hue_histogram(images, patch_radius, sat_low, val_low):
+    hist = np.zeros((180, 1), dtype=np.float32)
+    for cache_prefix, sample_centers in images:
+        hsv_image, _ = load_cached_image(cache_prefix)
+        image_height, image_width = hsv_image.shape[:2]
+        for x, y in sample_centers:
+            x0, y0 = max(int(x) - patch_radius, 0), max(int(y) - patch_radius, 0)
+            x1, y1 = min(int(x) + patch_radius + 1, image_width), min(int(y) + patch_radius + 1, image_height)
+            patch = np.ascontiguousarray(hsv_image[y0:y1, x0:x1])
+            mask = cv2.inRange(patch, np.array([0, sat_low, val_low], dtype=np.uint8),
+                               np.array([180, 255, 255], dtype=np.uint8))
+            hist += cv2.calcHist([patch], [0], mask, [180], [0, 180]).reshape(180, 1)
+    return hist
+
+
+def make_grid(color, images, args):
+    min_areas = [SampleParameters.MIN_SAMPLE_AREA * scale for scale in args["min_area_scales"]]
+    max_areas = [SampleParameters.MAX_SAMPLE_AREA * scale for scale in args["max_area_scales"]]
+    if color == SampleRecognition.SampleColor.YELLOW:
+        threshold_grid = [{"GREEN_CHANNEL_THRESHOLD_LOW": threshold} for threshold in args["green_thresholds"]]
+    else:
+        prefix = color.name + "_HSV_"
+        hist = get_labeled_hue_histogram(images, args["patch_radius"], min(args["sat_thresholds"]),
+                                         min(args["val_thresholds"]))
+        if hist.sum() > 0:
+            hue_low, hue_high = ImageUtils.get_hue_range(hist, int(np.argmax(hist)))
+            print(f"Hue range of the labeled {color.name} samples: {hue_low}, {hue_high}")
+        else:
+            hue_low, hue_high = getattr(SampleParameters, prefix + "HUE_LOW"), getattr(SampleParameters, prefix + "HUE_HIGH")
+
+        hue_lows = sorted({(hue_low + delta) % 180 for delta in args["hue_deltas"]})
+        hue_highs = sorted({(hue_high + delta) % 180 for delta in args["hue_deltas"]})
+        threshold_grid = [{prefix + "HUE_LOW": low, prefix + "HUE_HIGH": high,
+                           prefix + "SAT_THRESHOLD_LOW": sat, prefix + "VAL_THRESHOLD_LOW": val}
+                          for low, high, sat, val in itertools.product(hue_lows, hue_highs, args["sat_thresholds"],
+                                                                       args["val_thresholds"])]
+
+    return [dict(thresholds, color=color, MIN_SAMPLE_AREA=min_area, MAX_SAMPLE_AREA=max_area)
+            for thresholds, min_area, max_area in itertools.product(threshold_grid, min_areas, max_areas)
+            if min_area < max_area]
+
+
+# How far a setting is from the current SampleParameters, each value
+# relative to its current value.
+def get_distance_to_current(setting):
+    distance = 0.0
+    for name, value in setting.items():
+        if name != "color":
+            current_value = getattr(SampleParameters, name)
+            distance += abs(value - current_value) / max(abs(current_value), 1.0)
+    return distance
+
+
+# The most accurate setting, and of those the one closest to the
+# current SampleParameters. The time per frame is left out: the area
+# limits hardly change it and its noise would pick a different setting
+# on every run.
+def choose_best_setting(results):
+    best_accuracy = max(accuracy for _, accuracy, _ in results)
+    return min((setting for setting, accuracy, _ in results if accuracy == best_accuracy),
+               key=lambda setting: (get_distance_to_current(setting),
+                                    [value for name, value in sorted(setting.items()) if name != "color"]))
+
+
+def format_sample_parameters(setting):
+    lines = ["class SampleParameters:"]
+    for name, value in vars(SampleParameters).items():
+        if name.isupper():
+            lines.append(f"    {name} = {setting.get(name, value)!r}")
+    return "\n".join(lines)
+
+
+def write_labels(labels_path, image_dir, image_names, color):
+    setting = {name: value for name, value in vars(SampleParameters).items() if name.isupper()}
+    setting["color"] = color
+    num_labels = 0
+    with open(labels_path, "w", newline="") as labels_file:
+        writer = csv.DictWriter(labels_file, fieldnames=LABEL_FIELDS)
+        writer.writeheader()
+        for image_name in image_names:
+            image = cv2.imread(os.path.join(image_dir, image_name))
+            if image is None:
+                continue
+            contour = find_largest_contour(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), cv2.extractChannel(image, 1), setting)
+            if contour.size > 0:
+                (center_x, center_y), _, _ = cv2.minAreaRect(contour)
+                writer.writerow({"image": image_name, "color": color.name, "x": f"{center_x:.1f}", "y": f"{center_y:.1f}"})
+                num_labels += 1
+    print(f"Wrote {num_labels} {color.name} labels to {labels_path}; check them before calibrating")
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image_dir", type=str, required=True)
+    ap.add_argument("--labels", type=str, help="CSV file of labeled sample centers")
+    ap.add_argument("--write_labels", type=str, help="write labels from the current SampleParameters and stop")
+    ap.add_argument("--color", type=str, default="YELLOW", help="YELLOW, RED or BLUE")
+    ap.add_argument("--cache_dir", type=str, default=os.path.join(tempfile.gettempdir(), "sample_calibration_cache"))
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--tolerance", type=float, default=10.0, help="pixels between a detection and its label")
+    ap.add_argument("--top", type=int, default=5, help="number of best settings to list")
+    ap.add_argument("--green_thresholds", type=int, nargs="+", default=list(range(100, 240, 10)))
+    ap.add_argument("--hue_deltas", type=int, nargs="+", default=[-6, -3, 0, 3, 6],
+                    help="offsets from the hue range of the labeled samples")
+    ap.add_argument("--sat_thresholds", type=int, nargs="+", default=[30, 50, 70, 90])
+    ap.add_argument("--val_thresholds", type=int, nargs="+", default=[60, 100, 140])
+    ap.add_argument("--patch_radius", type=int, default=10, help="half size of the patch histogrammed per label")
+    ap.add_argument("--min_area_scales", type=float, nargs="+", default=[0.5, 0.75, 1.0],
+                    help="multiples of the current MIN_SAMPLE_AREA")
+    ap.add_argument("--max_area_scales", type=float, nargs="+", default=[1.0, 1.25, 1.5],
+                    help="multiples of the current MAX_SAMPLE_AREA")
+    args = vars(ap.parse_args())
+
+    color = SampleRecognition.SampleColor[args["color"]]
+    image_names = find_images(args["image_dir"])
+    if not image_names:
+        print('No images found in ' + args["image_dir"])
+        return 1
+
+    if args["write_labels"]:
+        write_labels(args["write_labels"], args["image_dir"], image_names, color)
+        return 0
+
+    if not args["labels"]:
+        print('--labels or --write_labels is required')
+        return 1
+
+    labels = read_labels(args["labels"])
+    os.makedirs(args["cache_dir"], exist_ok=True)
+    image_paths = [os.path.join(args["image_dir"], image_name) for image_name in image_names]
+    cache_prefixes = [get_cache_prefix(args["cache_dir"], image_path) for image_path in image_paths]
+
+    with multiprocessing.Pool(args["workers"]) as pool:
+        cached = pool.map(cache_image, zip(image_paths, cache_prefixes))
+
+    images = [(cache_prefix, [(x, y) for label_color, x, y in labels.get(image_name, []) if label_color == color])
+              for image_name, cache_prefix, ok in zip(image_names, cache_prefixes, cached) if ok]
+    grid = make_grid(color, images, args)
+    print(f"{len(images)} images, {sum(1 for _, centers in images if centers)} with {color.name} labels, "
+          f"{len(grid)} settings")
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args["workers"], initializer=init_worker, initargs=(images,)) as pool:
+        results = pool.map(evaluate_setting, [(setting, args["tolerance"]) for setting in grid],
+                           chunksize=max(1, len(grid) // (4 * args["workers"])))
+    print(f"Evaluated in {time.perf_counter() - start:.2f} s with {args['workers']} workers")
+
+    results.sort(key=lambda result: (-result[1], result[2]))
+    print(f"{'accuracy':>9}{'ms/frame':>10}  setting")
+    for setting, accuracy, frame_ms in results[:args["top"]]:
+        values = ", ".join(f"{name}={value}" for name, value in setting.items() if name != "color")
+        print(f"{accuracy:>9.3f}{frame_ms:>10.3f}  {values}")
+
+    print()
+    print(format_sample_parameters(choose_best_setting(results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+from detect_sample_as_runPipeline import OpenCVRotatedRect
+from detect_sample_as_runPipeline import SampleRecognition
+import argparse
+import cv2
+import numpy as np
+import sys
+import time
+
+# Checks that the batch geometry, get_sample_orientations_and_ftc_angles,
+# gives exactly the same orientation, FTC angle and int32 box points as
+# get_sample_orientation_and_ftc_angle and cv2.boxPoints, one rotated
+# rectangle at a time, over a dense sweep of angles and aspect ratios.
+# The angles run from -90 to 90 degrees: depending on the version,
+# cv2.minAreaRect returns angles in (0, 90] or in [-90, 0). The sweep
+# includes exactly -90, 0 and 90 degrees, squares (aspect ratio 1) and
+# random float32 centers, sizes and angles. Also reports the time per
+# rectangle of both.
+#
+# Example (from the project root):
+#   python source-files/runPipeline_GeometryCheck.py --angle_step 0.1
+
+
+def sweep_rects(angle_step, num_random, rng):
+    angles = np.append(np.arange(-90.0, 90.0, angle_step), [0.0, 90.0])
+    aspect_ratios = np.array([0.25, 0.5, 1.0 / 1.6, 0.9, 1.0, 1.1, 1.6, 2.0, 3.0, 4.0])
+    long_sides = np.array([20.0, 101.0, 187.5])
+    centers = np.array([[0.0, 0.0], [319.5, 239.5], [238.17295837402344, 68.09735870361328]])
+
+    rects = []
+    for angle in angles:
+        for aspect_ratio in aspect_ratios:
+            for long_side in long_sides:
+                for center_x, center_y in centers:
+                    rects.append((center_x, center_y, long_side, long_side / aspect_ratio, angle))
+
+    random_rects = np.column_stack([rng.uniform(0.0, 1280.0, (num_random, 2)), rng.uniform(1.0, 300.0, (num_random, 2)),
+                                    rng.uniform(-90.0, 90.0, num_random)])
+    random_squares = random_rects.copy()
+    random_squares[:, 3] = random_squares[:, 2]
+
+    # Squares and other rectangles at exactly -90, 0 and 90 degrees.
+    exact_angle_rects = np.vstack([random_rects[:num_random // 10], random_squares[:num_random // 10]])
+    exact_angle_rects = np.vstack([np.column_stack([exact_angle_rects[:, :4], np.full(len(exact_angle_rects), angle)])
+                                   for angle in (-90.0, 0.0, 90.0)])
+
+    # float32 like the values of an OpenCV RotatedRect.
+    return np.vstack([np.array(rects), random_rects, random_squares,
+                      exact_angle_rects]).astype(np.float32).astype(np.float64)
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--angle_step", type=float, default=0.25)
+    ap.add_argument("--num_random", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=5921)
+    args = vars(ap.parse_args())
+
+    rects = sweep_rects(args["angle_step"], args["num_random"], np.random.default_rng(args["seed"]))
+    recognition = SampleRecognition(SampleRecognition.Alliance.RED)
+
+    start = time.perf_counter()
+    scalar_results = []
+    for rect in rects:
+        opencv_rotated_rect = ((rect[0], rect[1]), (rect[2], rect[3]), rect[4])
+        orientation, ftc_angle = recognition.get_sample_orientation_and_ftc_angle(OpenCVRotatedRect(opencv_rotated_rect))
+        scalar_results.append((orientation.value, ftc_angle, np.int32(cv2.boxPoints(opencv_rotated_rect))))
+    scalar_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    orientations, ftc_angles, box_points = SampleRecognition.get_sample_orientations_and_ftc_angles(rects)
+    batch_seconds = time.perf_counter() - start
+
+    num_mismatches = 0
+    for i, (orientation, ftc_angle, points) in enumerate(scalar_results):
+        if orientations[i] != orientation or ftc_angles[i] != ftc_angle or not np.array_equal(box_points[i], points):
+            num_mismatches += 1
+            if num_mismatches <= 10:
+                print(f"MISMATCH {tuple(rects[i])}: scalar {orientation} {ftc_angle} {points.tolist()}, "
+                      f"batch {orientations[i]} {ftc_angles[i]} {box_points[i].tolist()}")
+
+    print(f"{len(rects)} rotated rects, {num_mismatches} mismatches")
+    print(f"scalar {scalar_seconds / len(rects) * 1e6:.2f} us per rect, "
+          f"batch {batch_seconds / len(rects) * 1e6:.3f} us per rect")
+    return 1 if num_mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+from detect_sample_as_runPipeline import PipelineOptions
+from detect_sample_as_runPipeline import SampleRecognition
+from detect_sample_as_runPipeline import recognition_engine
+import argparse
+import cv2
+import glob
+import os
+import time
+
+# Compares coarse-to-fine (pyramid) recognition against full-resolution
+# recognition on every image in a directory: the difference in FTC
+# angle and sample center, and the average time per frame.
+#
+# Example (from the project root):
+#   python source-files/runPipeline_PyramidComparison.py --image_dir=files/images --scales 2 4
+
+
+def time_recognition(image, alliance, num_iterations):
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        ret_val = recognition_engine.perform_recognition(alliance, image)
+    return ret_val, (time.perf_counter() - start) / num_iterations * 1000.0
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--image_dir", type=str, default=os.path.join("files", "images"))
+    ap.add_argument("--alliance", type=str, default="RED")
+    ap.add_argument("--scales", type=int, nargs="+", default=[2, 4])
+    ap.add_argument("--iterations", type=int, default=50)
+    args = vars(ap.parse_args())
+
+    alliance = SampleRecognition.Alliance[args["alliance"]]
+    image_paths = sorted(glob.glob(os.path.join(args["image_dir"], "*.png")))
+    if not image_paths:
+        print('No images found in ' + args["image_dir"])
+        return
+
+    success = SampleRecognition.SampleRecognitionReturn.RecognitionStatus.SUCCESS
+    PipelineOptions.ROI_TRACKING = False
+    PipelineOptions.SHOW_DEBUG_IMAGES = False
+    for image_path in image_paths:
+        image = cv2.imread(image_path)
+        if image is None:
+            print('Could not read ' + image_path)
+            continue
+
+        PipelineOptions.PYRAMID_SCALE = 1
+        full_res, full_res_ms = time_recognition(image, alliance, args["iterations"])
+        print(os.path.basename(image_path))
+        print(f"  full resolution: {full_res_ms:.3f} ms, status {full_res.status.name}, "
+              f"angle {full_res.ftc_angle:.2f}, "
+              f"center ({full_res.selected_sample_center_x:.2f}, {full_res.selected_sample_center_y:.2f})")
+
+        for scale in args["scales"]:
+            PipelineOptions.PYRAMID_SCALE = scale
+            pyramid, pyramid_ms = time_recognition(image, alliance, args["iterations"])
+            line = (f"  scale {scale}: {pyramid_ms:.3f} ms ({full_res_ms / pyramid_ms:.1f}x), "
+                    f"status {pyramid.status.name}, region {pyramid.search_region.name}")
+            if full_res.status == success and pyramid.status == success:
+                line += (f", angle error {abs(pyramid.ftc_angle - full_res.ftc_angle):.3f}, "
+                         f"center error ({abs(pyramid.selected_sample_center_x - full_res.selected_sample_center_x):.3f}, "
+                         f"{abs(pyramid.selected_sample_center_y - full_res.selected_sample_center_y):.3f})")
+            print(line)
+
+    PipelineOptions.PYRAMID_SCALE = 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import detect_sample_as_runPipeline
+from detect_sample_as_runPipeline import FrameRecorder
+from detect_sample_as_runPipeline import LLPYTHON_STATUS_SIZE
+from detect_sample_as_runPipeline import LLPythonBlock
+from detect_sample_as_runPipeline import PipelineOptions
+from detect_sample_as_runPipeline import PipelineStage
+from detect_sample_as_runPipeline import StageTimer
+from detect_sample_as_runPipeline import runPipeline
+import argparse
+import numpy as np
+import sys
+
+# Replays a file recorded with PipelineOptions.CAPTURE_FILE: every
+# frame, with its recorded llrobot input, is passed to runPipeline
+# straight from the memory-mapped file, so there is no image decoding
+# in the loop. Reports the per-stage latency percentiles over the
+# replay and, with --check, compares every llpython output bit for bit
+# with the recorded one.
+#
+# The STAGE_TIMING and FRAME_SEQUENCE blocks depend on timing and are
+# left out of the comparison. For identical outputs replay with the
+# PipelineOptions the match was recorded with, and with ASYNC_PIPELINE
+# off: an asynchronous result belongs to an earlier frame. The time
+# limits of ROI_TRACKING and RESULT_CACHE are also not reproduced.
+#
+# Example (from the project root):
+#   python source-files/runPipeline_Replay.py --capture match_12.llframes --check --iterations 5
+
+TIMING_BLOCKS = {LLPythonBlock.STAGE_TIMING.value, LLPythonBlock.FRAME_SEQUENCE.value}
+
+
+# The llpython values without the blocks that depend on timing.
+def get_deterministic_values(llpython):
+    values = list(llpython[:LLPYTHON_STATUS_SIZE])
+    index = LLPYTHON_STATUS_SIZE
+    while index + 1 < len(llpython):
+        block_id, num_values = int(llpython[index]), int(llpython[index + 1])
+        block_end = index + 2 + num_values
+        if block_id not in TIMING_BLOCKS:
+            values.extend(llpython[index:block_end])
+        index = block_end
+    return np.array(values, dtype=np.float64)
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--capture", type=str, required=True, help="file recorded with PipelineOptions.CAPTURE_FILE")
+    ap.add_argument("--iterations", type=int, default=1, help="number of times the whole file is replayed")
+    ap.add_argument("--check", action="store_true", help="compare the outputs with the recorded outputs")
+    ap.add_argument("--max_reported", type=int, default=10, help="mismatches listed with --check")
+    args = vars(ap.parse_args())
+
+    records = FrameRecorder.open_records(args["capture"])
+    if len(records) == 0:
+        print('No frames in ' + args["capture"])
+        return 1
+
+    PipelineOptions.SHOW_DEBUG_IMAGES = False
+    PipelineOptions.CAPTURE_FILE = None
+    PipelineOptions.ASYNC_PIPELINE = False
+    duration_s = (int(records[-1]["timestamp_ns"]) - int(records[0]["timestamp_ns"])) / 1e9
+    print(f"{len(records)} frames of {records[0]['frame'].shape}, recorded over {duration_s:.2f} s")
+
+    timer = StageTimer(len(records) * args["iterations"])
+    detect_sample_as_runPipeline.set_stage_timer(timer)
+    num_mismatches = 0
+    try:
+        for iteration in range(args["iterations"]):
+            for index, record in enumerate(records):
+                llrobot = record["llrobot"][:record["llrobot_count"]].tolist()
+                _, _, llpython = runPipeline(record["frame"], llrobot)
+                if not args["check"]:
+                    continue
+
+                recorded = get_deterministic_values(record["llpython"][:record["llpython_count"]])
+                replayed = get_deterministic_values(np.array(llpython, dtype=np.float64))
+                if not np.array_equal(recorded, replayed):
+                    num_mismatches += 1
+                    if num_mismatches <= args["max_reported"]:
+                        print(f"MISMATCH iteration {iteration} frame {index}: recorded {recorded.tolist()}, "
+                              f"replayed {replayed.tolist()}")
+    finally:
+        detect_sample_as_runPipeline.set_stage_timer(None)
+
+    frame_ms = timer.get_frame_ms()
+    print(f"{'stage':<20}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage in PipelineStage:
+        stage_ms = frame_ms[:, stage.value]
+        print(f"{stage.name:<20}" + "".join(f"{value:>10.3f}" for value in
+                                            np.percentile(stage_ms, [50, 95, 99]).tolist() + [stage_ms.max()]))
+
+    if args["check"]:
+        print(f"{len(records) * args['iterations']} frames replayed, {num_mismatches} mismatches")
+        return 1 if num_mismatches else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
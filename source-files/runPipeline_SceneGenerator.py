@@ -0,0 +1,167 @@
+from detect_sample_as_runPipeline import SampleRecognition
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+
+# Renders synthetic scenes of samples on a gray mat with known ground
+# truth: the color, center, size and FTC angle of every sample. The
+# scenes depend only on the seed, so a stress test or a comparison
+# between two versions of the pipeline always sees the same images.
+#
+# Sizes are given for 640x480 and scaled to the resolution of the
+# scene. The first sample of a scene is the largest so that the sample
+# runPipeline should select is known. The FTC angle follows the
+# pipeline's convention: 90 for a horizontal sample, 45 for one turned
+# counter-clockwise from vertical and 135 for one turned clockwise;
+# a vertical sample is reported as 0 or 180.
+#
+# Example (from the project root), writes the scenes and truth.json:
+#   python source-files/runPipeline_SceneGenerator.py --output_dir synthetic --resolutions 640x480 1280x960
+
+REFERENCE_WIDTH = 640
+SAMPLE_LONG_SIDE = 190.0  # pixels at 640x480; 3.5" side of a sample
+SAMPLE_SHORT_SIDE = 82.0  # 1.5" side
+MAT_BGR = (95, 90, 85)
+SAMPLE_BGR = {SampleRecognition.SampleColor.YELLOW: (30, 220, 235),
+              SampleRecognition.SampleColor.RED: (45, 40, 195),
+              SampleRecognition.SampleColor.BLUE: (190, 70, 35)}
+
+# Angles that exercise every branch of get_sample_orientation_and_ftc_angle.
+EDGE_CASE_ANGLES = (0.0, 45.0, 90.0, 135.0)
+
+
+class SyntheticSample:
+    def __init__(self, color, center_x, center_y, long_side, short_side, ftc_angle):
+        self.color = color
+        self.center_x = center_x
+        self.center_y = center_y
+        self.long_side = long_side
+        self.short_side = short_side
+        self.ftc_angle = ftc_angle
+
+    def to_dict(self):
+        return {"color": self.color.name, "center_x": self.center_x, "center_y": self.center_y,
+                "long_side": self.long_side, "short_side": self.short_side, "ftc_angle": self.ftc_angle}
+
+    # The corners of the sample; the long side points up at FTC angle 0
+    # and turns counter-clockwise as the angle increases.
+    def get_corners(self):
+        radians = np.radians(self.ftc_angle)
+        long_axis = np.array([-np.sin(radians), -np.cos(radians)]) * (self.long_side / 2.0)
+        short_axis = np.array([-np.cos(radians), np.sin(radians)]) * (self.short_side / 2.0)
+        center = np.array([self.center_x, self.center_y])
+        return np.array([center + long_axis + short_axis, center + long_axis - short_axis,
+                         center - long_axis - short_axis, center - long_axis + short_axis])
+
+
+# The difference between two FTC angles of a sample, which is the same
+# sample when it is turned through 180 degrees.
+def ftc_angle_error(p_angle, p_truth):
+    difference = abs(p_angle - p_truth) % 180.0
+    return min(difference, 180.0 - difference)
+
+
+# Returns the list of SyntheticSample, or None if one of them didn't fit.
+def place_samples(p_rng, p_width, p_height, p_colors, p_scale, p_edge_case_fraction):
+    samples = []
+    for index, color in enumerate(p_colors):
+        # The first sample is clearly larger than the rest.
+        size_scale = p_rng.uniform(0.98, 1.05) if index == 0 else p_rng.uniform(0.8, 0.9)
+        long_side = SAMPLE_LONG_SIDE * p_scale * size_scale
+        short_side = SAMPLE_SHORT_SIDE * p_scale * size_scale
+        if p_rng.random() < p_edge_case_fraction:
+            ftc_angle = float(p_rng.choice(EDGE_CASE_ANGLES))
+        else:
+            ftc_angle = float(p_rng.uniform(0.0, 180.0))
+
+        # Keep samples inside the image and apart from each other.
+        radius = np.hypot(long_side, short_side) / 2.0 + 2.0 * p_scale
+        for _ in range(1000):
+            center_x = float(p_rng.uniform(radius, p_width - radius))
+            center_y = float(p_rng.uniform(radius, p_height - radius))
+            if all(np.hypot(center_x - other.center_x, center_y - other.center_y) >
+                   radius + np.hypot(other.long_side, other.short_side) / 2.0 for other in samples):
+                break
+        else:
+            return None
+
+        samples.append(SyntheticSample(color, center_x, center_y, long_side, short_side, ftc_angle))
+    return samples
+
+
+# Returns the BGR image and the list of SyntheticSample, largest first.
+# p_colors gives the color of each sample. p_noise_sigma is the standard
+# deviation of the Gaussian noise added to every channel and p_lighting
+# the fraction by which the brightness varies across the image.
+def generate_scene(p_rng, p_width, p_height, p_colors, p_noise_sigma=4.0, p_lighting=0.2, p_edge_case_fraction=0.3):
+    scale = p_width / REFERENCE_WIDTH
+    image = np.empty((p_height, p_width, 3), dtype=np.float32)
+    image[:] = MAT_BGR
+
+    # A sample placed near the middle can leave no room for the rest, so
+    # the whole layout is started again when one doesn't fit.
+    for _ in range(100):
+        samples = place_samples(p_rng, p_width, p_height, p_colors, scale, p_edge_case_fraction)
+        if samples is not None:
+            break
+    else:
+        raise ValueError(f"No room for {len(p_colors)} samples at {p_width}x{p_height}")
+
+    for sample in samples:
+        cv2.fillPoly(image, [np.round(sample.get_corners() * 16.0).astype(np.int32)], SAMPLE_BGR[sample.color],
+                     lineType=cv2.LINE_AA, shift=4)
+
+    # Brightness that changes linearly in a random direction.
+    direction = p_rng.uniform(-1.0, 1.0, 2)
+    ys, xs = np.mgrid[0:p_height, 0:p_width].astype(np.float32)
+    gradient = (direction[0] * (xs / p_width - 0.5) + direction[1] * (ys / p_height - 0.5))
+    image *= (1.0 + p_lighting * gradient)[:, :, np.newaxis]
+    image += p_rng.normal(0.0, p_noise_sigma, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8), samples
+
+
+def parse_resolution(p_resolution):
+    width, height = p_resolution.lower().split("x")
+    return int(width), int(height)
+
+
+# Colors for a scene of p_num_samples: the target first, then a mix.
+def choose_colors(p_rng, p_num_samples, p_target_color=SampleRecognition.SampleColor.YELLOW):
+    colors = list(SAMPLE_BGR)
+    return [p_target_color] + [colors[p_rng.integers(len(colors))] for _ in range(p_num_samples - 1)]
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output_dir", type=str, required=True)
+    ap.add_argument("--seed", type=int, default=5921)
+    ap.add_argument("--resolutions", type=str, nargs="+", default=["320x240", "640x480", "1280x960"])
+    ap.add_argument("--num_samples", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--num_scenes", type=int, default=10, help="scenes per resolution and number of samples")
+    ap.add_argument("--noise", type=float, default=4.0)
+    ap.add_argument("--lighting", type=float, default=0.2)
+    args = vars(ap.parse_args())
+
+    os.makedirs(args["output_dir"], exist_ok=True)
+    rng = np.random.default_rng(args["seed"])
+    truth = {}
+    for resolution in args["resolutions"]:
+        width, height = parse_resolution(resolution)
+        for num_samples in args["num_samples"]:
+            for scene_index in range(args["num_scenes"]):
+                image, samples = generate_scene(rng, width, height, choose_colors(rng, num_samples),
+                                                args["noise"], args["lighting"])
+                filename = f"synthetic_{width}x{height}_{num_samples}_{scene_index:03d}.png"
+                cv2.imwrite(os.path.join(args["output_dir"], filename), image)
+                truth[filename] = [sample.to_dict() for sample in samples]
+
+    with open(os.path.join(args["output_dir"], "truth.json"), "w") as truth_file:
+        json.dump(truth, truth_file, indent=2)
+    print(f"Wrote {len(truth)} scenes to {args['output_dir']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+from detect_sample_as_runPipeline import LLRobot
+from detect_sample_as_runPipeline import PipelineOptions
+from detect_sample_as_runPipeline import SampleParameters
+from detect_sample_as_runPipeline import SampleRecognition
+from detect_sample_as_runPipeline import runPipeline
+from runPipeline_SceneGenerator import REFERENCE_WIDTH
+from runPipeline_SceneGenerator import choose_colors
+from runPipeline_SceneGenerator import ftc_angle_error
+from runPipeline_SceneGenerator import generate_scene
+from runPipeline_SceneGenerator import parse_resolution
+import argparse
+import numpy as np
+import sys
+import time
+
+# Runs runPipeline over seeded synthetic scenes (see
+# runPipeline_SceneGenerator.py) at several resolutions and numbers of
+# samples and reports, for each combination, the frames per second and
+# per-frame latency against a frame budget, the fraction of scenes in
+# which the largest sample was selected, and the angle and center
+# errors of the selected sample against the ground truth.
+#
+# SampleParameters.MIN_SAMPLE_AREA and MAX_SAMPLE_AREA are tuned for
+# 640x480; they are scaled by the square of (width / 640) for each
+# resolution and restored afterwards.
+#
+# Example (from the project root):
+#   python source-files/runPipeline_StressTest.py --num_scenes 20 --frame_budget_ms 11.1
+
+
+def run_scenes(scenes, llrobot, iterations):
+    frame_ms = []
+    results = []
+    for image, samples in scenes:
+        runPipeline(image, llrobot)  # warm up the buffers for this resolution
+        for _ in range(iterations):
+            start = time.perf_counter()
+            _, _, llpython = runPipeline(image, llrobot)
+            frame_ms.append((time.perf_counter() - start) * 1000.0)
+        results.append((llpython, samples))
+    return np.array(frame_ms), results
+
+
+# The scene's first sample is the largest and the one to select.
+def score_results(results):
+    num_selected = 0
+    angle_errors = []
+    center_errors = []
+    for llpython, samples in results:
+        if llpython[0] != SampleRecognition.SampleRecognitionReturn.RecognitionStatus.SUCCESS.value:
+            continue
+
+        _, color_value, ftc_angle, center_x, center_y = llpython[:5]
+        distances = [np.hypot(center_x - sample.center_x, center_y - sample.center_y) for sample in samples]
+        nearest = int(np.argmin(distances))
+        if nearest != 0 or color_value != samples[0].color.value:
+            continue
+
+        num_selected += 1
+        angle_errors.append(ftc_angle_error(ftc_angle, samples[0].ftc_angle))
+        center_errors.append(distances[0])
+    return num_selected / len(results), np.array(angle_errors), np.array(center_errors)
+
+
+def main():
+    # Construct the argument parser and parse the arguments.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=5921)
+    ap.add_argument("--resolutions", type=str, nargs="+", default=["320x240", "640x480", "1280x960"])
+    ap.add_argument("--num_samples", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--num_scenes", type=int, default=10, help="scenes per resolution and number of samples")
+    ap.add_argument("--iterations", type=int, default=20, help="timed runs of each scene")
+    ap.add_argument("--alliance", type=str, default="RED")
+    ap.add_argument("--multi_color", action="store_true", help="the target may also be of the alliance color")
+    ap.add_argument("--output_mode", type=str, default="ANNOTATED", help="ANNOTATED, MINIMAL or DEBUG")
+    ap.add_argument("--frame_budget_ms", type=float, default=1000.0 / 90.0)
+    ap.add_argument("--noise", type=float, default=4.0)
+    ap.add_argument("--lighting", type=float, default=0.2)
+    args = vars(ap.parse_args())
+
+    alliance = SampleRecognition.Alliance[args["alliance"]]
+    target_colors = [SampleRecognition.SampleColor.YELLOW]
+    if args["multi_color"]:
+        target_colors.append(SampleRecognition.SampleColor[alliance.name])
+    llrobot = [alliance.value, LLRobot.StageTiming.OFF.value, SampleRecognition.OutputMode[args["output_mode"]].value]
+
+    PipelineOptions.SHOW_DEBUG_IMAGES = False
+    PipelineOptions.MULTI_COLOR = args["multi_color"]
+    min_sample_area = SampleParameters.MIN_SAMPLE_AREA
+    max_sample_area = SampleParameters.MAX_SAMPLE_AREA
+    rng = np.random.default_rng(args["seed"])
+
+    print(f"frame budget {args['frame_budget_ms']:.2f} ms; errors are mean / max")
+    print(f"{'resolution':<12}{'samples':>8}{'fps':>9}{'mean ms':>9}{'p95 ms':>9}{'selected':>10}"
+          f"{'angle err':>16}{'center err':>16}")
+    over_budget = False
+    try:
+        for resolution in args["resolutions"]:
+            width, height = parse_resolution(resolution)
+            area_scale = (width / REFERENCE_WIDTH) ** 2
+            SampleParameters.MIN_SAMPLE_AREA = min_sample_area * area_scale
+            SampleParameters.MAX_SAMPLE_AREA = max_sample_area * area_scale
+
+            for num_samples in args["num_samples"]:
+                scenes = [generate_scene(rng, width, height,
+                                         choose_colors(rng, num_samples,
+                                                       target_colors[rng.integers(len(target_colors))]),
+                                         args["noise"], args["lighting"])
+                          for _ in range(args["num_scenes"])]
+                frame_ms, results = run_scenes(scenes, llrobot, args["iterations"])
+                selected, angle_errors, center_errors = score_results(results)
+
+                mean_ms = float(np.mean(frame_ms))
+                p95_ms = float(np.percentile(frame_ms, 95))
+                budget_flag = ""
+                if p95_ms > args["frame_budget_ms"]:
+                    budget_flag = "  OVER BUDGET"
+                    over_budget = True
+                angle_error = (f"{angle_errors.mean():.2f} / {angle_errors.max():.2f}" if angle_errors.size
+                               else "-")
+                center_error = (f"{center_errors.mean():.2f} / {center_errors.max():.2f}" if center_errors.size
+                                else "-")
+                print(f"{resolution:<12}{num_samples:>8}{1000.0 / mean_ms:>9.1f}{mean_ms:>9.3f}{p95_ms:>9.3f}"
+                      f"{selected:>10.0%}{angle_error:>16}{center_error:>16}{budget_flag}")
+    finally:
+        SampleParameters.MIN_SAMPLE_AREA = min_sample_area
+        SampleParameters.MAX_SAMPLE_AREA = max_sample_area
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,7 @@
 from detect_sample_as_runPipeline import runPipeline
 from detect_sample_as_runPipeline import SampleRecognition
+from detect_sample_as_runPipeline import PipelineLog
+from detect_sample_as_runPipeline import pipeline_log
 import argparse
 import cv2
 import os
@@ -8,6 +10,7 @@ def main():
     # Construct the argument parser and parse the arguments.
     ap = argparse.ArgumentParser()
     ap.add_argument("--image_dir", type=str)
+    ap.add_argument("--output_mode", type=str, default="ANNOTATED", help="ANNOTATED, MINIMAL or DEBUG")
     args = vars(ap.parse_args())
 
     ##** CHANGE the next two lines for the file and/or alliance you want to test. **
@@ -24,7 +27,11 @@ def main():
 
     alliance_instance = SampleRecognition.Alliance[alliance]
 
-    _, result_image, lloutput = runPipeline(src, [alliance_instance.value])
+    # Show all of the pipeline's log messages.
+    pipeline_log.set_level(PipelineLog.Level.DEBUG)
+    output_mode = SampleRecognition.OutputMode[args["output_mode"]]
+    _, result_image, lloutput = runPipeline(src, [alliance_instance.value, 0, output_mode.value])
+    pipeline_log.flush()
     print(lloutput)
 
     # show the image